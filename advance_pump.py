@@ -4,13 +4,25 @@ from __future__ import print_function
 
 # standard library imports
 import json  # for working with data file
-from threading import Thread, Lock
-from time import sleep
+import os
+import sys
+import hashlib
+import gzip
+import re
+from email.utils import formatdate
+import queue
+from threading import Thread, Lock, Event, Condition
+from time import monotonic, sleep
 import copy
-from datetime import datetime
-
-# request HTTP
-import requests
+import heapq
+import random
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from collections import namedtuple
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # local module imports
 from blinker import signal
@@ -39,289 +51,2766 @@ urls.extend([
     u"/advance-pump-switch-state", u"plugins.advance_pump.pump_is_on",
     u"/advance-pump-switch-manual", u"plugins.advance_pump.pump_change_manual_state",
     u"/advance-pump-list", u"plugins.advance_pump.pump_get_list",
+    u"/advance-pump-status", u"plugins.advance_pump.pump_get_status",
+    u"/advance-pump-status-wait", u"plugins.advance_pump.pump_wait_status",
+    u"/advance-pump-metrics", u"plugins.advance_pump.pump_get_metrics",
+    u"/advance-pump-profile", u"plugins.advance_pump.pump_profile",
+    u"/advance-pump-config", u"plugins.advance_pump.pump_config",
+    u"/advance-pump-history", u"plugins.advance_pump.pump_get_history",
     ])
 # fmt: on
 
 # Add this plugin to the PLUGINS menu ["Menu Name", "URL"], (Optional)
 gv.plugin_menu.append([_(u"Advance Pump"), u"/advance-pump-home"])
 
-settingsAdvancePump = {'PumpDBLog': True, 'PumpName': [], 'PumpDeviceType': [], 'PumpIP': [], 'PumpNeedValves': [], 'PumpNeedValvesOn': [], 'PumpNeedValvesOff': [], 'PumpKeepState': [], 'PumpPower': [], 'PumpMinWorkingTime': []}
-advancePumpManualMode = {}
+# metrics of plugin, histograms of times in seconds and counters. Each value cost one bisect and one short lock
+metricsBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metricsHelp = {
+    'advance_pump_http_seconds': ('histogram', "Time of HTTP requests to devices, with retries"),
+    'advance_pump_http_errors_total': ('counter', "Failed HTTP requests to devices by error type"),
+    'advance_pump_commands_total': ('counter', "Commands sent to pumps by result"),
+    'advance_pump_lease_renewals_total': ('counter', "Auto-off lease renewals of running pumps by result"),
+    'advance_pump_mqtt_messages_total': ('counter', "MQTT messages received and commands published by type"),
+    'advance_pump_mqtt_connects_total': ('counter', "Connections to MQTT broker by result"),
+    'advance_pump_loop_seconds': ('histogram', "Time of control loop iterations"),
+    'advance_pump_sweep_seconds': ('histogram', "Time of status sweeps, from first request to last answer"),
+    'advance_pump_lock_wait_seconds': ('histogram', "Time waiting for plugin locks"),
+    'advance_pump_db_write_seconds': ('histogram', "Time of data-base batch writes"),
+    'advance_pump_db_errors_total': ('counter', "Data-base batch writes with error"),
+    }
+metricsValues = {} # (metric name, labels): histogram list (bucket counts, sum, count) or counter value
+mutexMetrics = Lock()
+
+def observeMetric(metricName : str, value : float, labels = ()):
+    """ Add value to histogram, labels is tuple of (label name, label value)"""
+    bucketId = bisect_left(metricsBuckets, value)
+
+    with mutexMetrics:
+        histogram = metricsValues.get((metricName, labels))
+        if histogram is None:
+            histogram = [0] * (len(metricsBuckets) + 1) + [0.0, 0]
+            metricsValues[(metricName, labels)] = histogram
+        histogram[bucketId] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def countMetric(metricName : str, labels = (), amount = 1):
+    """ Add amount to counter, labels is tuple of (label name, label value)"""
+    with mutexMetrics:
+        metricsValues[(metricName, labels)] = metricsValues.get((metricName, labels), 0) + amount
+
+class TimedLock(object):
+    """
+    Lock that save time waiting for it in advance_pump_lock_wait_seconds, used in 'with' blocks
+    """
+
+    def __init__(self, lockName : str):
+        self.lock = Lock()
+        self.labels = (('lock', lockName),)
+
+    def __enter__(self):
+        if self.lock.acquire(False):
+            observeMetric('advance_pump_lock_wait_seconds', 0.0, self.labels)
+        else:
+            waitStart = monotonic()
+            self.lock.acquire()
+            observeMetric('advance_pump_lock_wait_seconds', monotonic() - waitStart, self.labels)
+        return self
 
-mutexAdvPump = Lock()
+    def __exit__(self, excType, excValue, traceback):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+advancePumpManualMode = {} # manual state of pumps, pump uid: state. Replaced in each change, readers keep reference without lock
+
+# control state: manual mode changes, commands waiting for device, switch times and power budget.
+# Lock order is mutexAdvPump before stateAdvPump.lock, settings are read from snapshot without lock
+mutexAdvPump = TimedLock('control')
 threadMain = None
 isRuning = True
 
-def requestHTTP(commandURL):
+# control thread sleep until this event or next periodic task
+wakeAdvPump = Event()
+
+# valves mask in last zone change, with settings version used to check it
+lastValvesMask = None
+mutexZoneChange = Lock()
+
+keepStatePeriod = 30 # seconds between keep state commands
+onlineCheckPeriod = 30 # seconds between status requests of healthy pumps
+pollMinPeriod = 1 # minimum seconds between status sweeps
+
+# health of each pump, off-line pumps are polled with exponential backoff
+pumpHealthy, pumpSuspect, pumpOffline, pumpRecovering = range(4)
+pumpHealthNames = ('healthy', 'suspect', 'offline', 'recovering')
+healthSuspectFailures = 2 # failed requests to consider pump off-line
+healthRecoverAnswers = 2 # answers after off-line to consider pump healthy
+suspectPollPeriod = 5 # seconds to check again pump that fail one request
+recoveringPollPeriod = 10 # seconds between status requests of recovering pumps
+offlineBackoffBase = 30 # seconds to first status request of off-line pump, double in each failure
+offlineBackoffMax = 600 # maximum seconds between status requests of off-line pump
+offlineBackoffJitter = 0.2 # random part of backoff, off-line devices are not requested at same time
+
+# commands waiting for device answer, pump uid: (state sent, pump address)
+pendingCommands = {}
+observedStaleTime = 90 # seconds after device state is not used to skip commands
+
+# failed commands are sent again by control thread, wait double in each failure
+commandRetryBase = 2 # seconds to first retry of failed command
+commandRetryMax = 60 # maximum seconds between retries
+commandFailures = {} # pump uid: failed commands in sequence
+commandsFailed = set() # pumps with failed command, control thread schedule retry
+
+# running pumps turned on with device auto-off timer (PumpLeaseTime), device stop pump if plugin stop renew it
+leaseMinTime = 10 # minimum seconds of lease, renew need time to reach device
+leaseRenewFraction = 3 # lease is renewed this number of times before expire
+leaseAnswered = set() # pumps with renew answer, control thread check them again
+
+# pumps changes planned from SIP run schedule (gv.rs), pumps change PumpLookahead seconds before valves
+lookaheadPeriod = 5 # seconds between plans of run schedule
+plannedGraceTime = 10 # seconds that planned state is kept after valves time, zone change signal confirm it
+plannedWarmTime = 2 # seconds before planned change that device status is requested, connection is open when command is sent
+plannedStatesAdvPump = MappingProxyType({}) # pump uid: state of planned changes in progress, replaced by control thread
+
+# last turn on and turn off command time of each pump, pump uid: (on time, off time)
+pumpSwitchTimes = {}
+lastStartTime = float('-inf') # last pump turn on, next start wait PumpStartStagger
+
+# power of pumps turned on, pumps start only if total stay under PumpPowerBudget
+pumpLoad = {} # pump uid: power counted in running power
+runningPower = 0.0
+waitingPumps = {} # pumps waiting for power, pump uid: (priority, request time, power)
+queuedPower = 0.0
+
+# pumps state version, web clients wait for a new version instead of polling
+stateVersionAdvPump = 0
+stateChangedAdvPump = Condition()
+stateWaitTimeout = 25 # seconds that one client wait for new state, before answer with same state
+stateMaxWaiters = 2 # maximum clients waiting, each one keep one of the 10 web server threads
+stateWaiters = 0
+stateSignatureAdvPump = None # values shown to clients in last version
+
+# devices are polled in parallel, a slow device only delay is own answer
+pollMaxWorkers = 8 # maximum number of devices requested at same time
+poolAdvPump = ThreadPoolExecutor(max_workers = pollMaxWorkers)
+
+# relay commands have own workers, status requests to devices without answer do not delay them.
+# Each pump have at most one command waiting answer, commands wait for a worker only if more pumps than workers wait devices
+commandMaxWorkers = 32 # maximum number of commands sent at same time, threads are created only when needed
+poolCommands = ThreadPoolExecutor(max_workers = commandMaxWorkers)
+
+# request HTTP, imported by first device request and not in plugin load
+requests = None
+HTTPAdapter = None
+Retry = None
+mutexHTTPStack = Lock()
+
+def loadHTTPStack():
+    """ Import requests once, threads that request devices before it is ready wait for it"""
+    global requests, HTTPAdapter, Retry
+
+    if requests is not None:
+        return
+
+    with mutexHTTPStack:
+        if requests is None:
+            import requests as requestsModule
+            from requests.adapters import HTTPAdapter as adapterClass
+            from urllib3.util.retry import Retry as retryClass
+
+            HTTPAdapter = adapterClass
+            Retry = retryClass
+            requests = requestsModule
+
+# keep-alive HTTP session for each device, reuse TCP connections between requests
+sessionsAdvPump = {}
+mutexSessions = Lock()
+httpConfigAdvPump = {}
+httpConfigKeys = ['PumpHTTPPoolSize', 'PumpHTTPConnectTimeout', 'PumpHTTPReadTimeout', 'PumpHTTPRetries', 'PumpHTTPBackoff']
+
+def setHTTPConfig(localSettings):
+    """ Change device connection parameters, open sessions are closed to use new parameters"""
+    global httpConfigAdvPump
+
+    newConfig = {}
+    for configKey in httpConfigKeys:
+        newConfig[configKey] = localSettings.get(configKey, defaultSettingsAdvancePump[configKey])
+
+    with mutexSessions:
+        httpConfigAdvPump = newConfig
+        for deviceHost in sessionsAdvPump:
+            sessionsAdvPump[deviceHost].close()
+        sessionsAdvPump.clear()
+
+def getDeviceSession(deviceHost : str):
+    """ Return keep-alive session of device, create it in first request"""
+    with mutexSessions:
+        session = sessionsAdvPump.get(deviceHost)
+        if session is None:
+            retries = Retry(total = int(httpConfigAdvPump['PumpHTTPRetries']), backoff_factor = float(httpConfigAdvPump['PumpHTTPBackoff']), status_forcelist = [502, 503, 504])
+            adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = int(httpConfigAdvPump['PumpHTTPPoolSize']), max_retries = retries)
+
+            session = requests.Session()
+            session.mount(u"http://", adapter)
+            sessionsAdvPump[deviceHost] = session
+
+    return session
+
+def getHTTPTimeout():
+    """ Connect and read timeout for each request to devices"""
+    return (float(httpConfigAdvPump['PumpHTTPConnectTimeout']), float(httpConfigAdvPump['PumpHTTPReadTimeout']))
+
+def getSweepDeadline():
+    """ Seconds to wait for all devices in one sweep, include all retries of one request"""
+    connectTimeout, readTimeout = getHTTPTimeout()
+    retries = int(httpConfigAdvPump['PumpHTTPRetries'])
+    backoff = float(httpConfigAdvPump['PumpHTTPBackoff'])
+
+    return (connectTimeout + readTimeout) * (retries + 1) + backoff * (2 ** retries) + 1
+
+defaultSettingsAdvancePump = {'PumpDBLog': True, 'PumpName': [], 'PumpDeviceType': [], 'PumpIP': [], 'PumpNeedValves': [], 'PumpNeedValvesOn': [], 'PumpNeedValvesOff': [], 'PumpKeepState': [], 'PumpPower': [], 'PumpMinWorkingTime': [], 'PumpMinOffTime': [], 'PumpPriority': [], 'PumpUID': [], 'PumpMQTTId': [],
+                              'PumpNextUID': 1, 'PumpStartStagger': 2.0, 'PumpPowerBudget': 0.0, 'PumpLeaseTime': 0, 'PumpLookahead': 0.0, 'PumpHTTPPoolSize': 2, 'PumpHTTPConnectTimeout': 2.0, 'PumpHTTPReadTimeout': 3.0, 'PumpHTTPRetries': 1, 'PumpHTTPBackoff': 0.5,
+                              'PumpMQTTHost': u"", 'PumpMQTTPort': 1883, 'PumpMQTTUser': u"", 'PumpMQTTPassword': u""}
+
+# options saved in file but never sent by list, configuration API or settings page, they could only be changed
+secretSettingKeys = ['PumpMQTTPassword']
+
+# per pump settings in file, list with one element for each pump: (file key, record field, default value)
+pumpRecordFields = [('PumpName', 'name', u""), ('PumpDeviceType', 'deviceType', u""), ('PumpIP', 'ip', u""), ('PumpNeedValves', 'needValves', ()), ('PumpNeedValvesOn', 'needValvesOn', ()),
+                    ('PumpNeedValvesOff', 'needValvesOff', ()), ('PumpKeepState', 'keepState', False), ('PumpPower', 'power', u""), ('PumpMinWorkingTime', 'minWorkingTime', u""),
+                    ('PumpMinOffTime', 'minOffTime', u""), ('PumpPriority', 'priority', 0), ('PumpUID', 'uid', 0), ('PumpMQTTId', 'mqttId', u"")]
+
+PumpRecord = namedtuple('PumpRecord', [recordField[1] for recordField in pumpRecordFields])
+
+class SettingsSnapshot(object):
+    """
+    Immutable settings of plugin, a new snapshot is published when settings change.
+    Readers only need to keep the reference, no copy or lock.
+    """
+    __slots__ = ('version', 'pumps', 'options', 'valvesIndex', 'pumpMasks', 'pumpTimes', 'pumpPowers', 'pumpUIDs', 'uidIndex')
+
+    def __init__(self, version, pumps, options, valvesIndex, pumpMasks, pumpTimes, pumpPowers, pumpUIDs, uidIndex):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'pumps', pumps)
+        object.__setattr__(self, 'options', options)
+        object.__setattr__(self, 'valvesIndex', valvesIndex)
+        object.__setattr__(self, 'pumpMasks', pumpMasks)
+        object.__setattr__(self, 'pumpTimes', pumpTimes)
+        object.__setattr__(self, 'pumpPowers', pumpPowers)
+        object.__setattr__(self, 'pumpUIDs', pumpUIDs)
+        object.__setattr__(self, 'uidIndex', uidIndex)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("settings snapshot is read only")
+
+    def to_dict(self):
+        """ Settings in file format, new lists that could be changed"""
+        settingsDict = dict(self.options)
+        for fileKey, recordField, defaultValue in pumpRecordFields:
+            if isinstance(defaultValue, tuple):
+                settingsDict[fileKey] = [list(getattr(pump, recordField)) for pump in self.pumps]
+            else:
+                settingsDict[fileKey] = [getattr(pump, recordField) for pump in self.pumps]
+        return settingsDict
+
+def parseMinTime(minTime):
+    """ Minimum time from settings page in seconds, 'HH:MM' or 'HH:MM:SS', number is seconds"""
+    if isinstance(minTime, (int, float)):
+        return max(float(minTime), 0.0)
+
+    try:
+        timeParts = [float(timePart) for timePart in minTime.strip().split(u":")] if minTime.strip() else []
+    except ValueError:
+        return 0.0
+
+    seconds = 0.0
+    if len(timeParts) == 1:
+        seconds = timeParts[0]
+    elif len(timeParts) >= 2:
+        seconds = timeParts[0] * 3600 + timeParts[1] * 60 + (timeParts[2] if len(timeParts) > 2 else 0)
+
+    return max(seconds, 0.0)
+
+def buildSettingsSnapshot(settingsDict, version):
+    """ Convert settings from file format to snapshot, build valves to pumps index and valves bit masks of each pump"""
+    options = {}
+    for settingKey in defaultSettingsAdvancePump:
+        if not isinstance(defaultSettingsAdvancePump[settingKey], list):
+            options[settingKey] = settingsDict.get(settingKey, defaultSettingsAdvancePump[settingKey])
+
+    pumps = []
+    for pumpId in range(len(settingsDict.get('PumpName', []))):
+        pumpValues = []
+        for fileKey, recordField, defaultValue in pumpRecordFields:
+            fileValues = settingsDict.get(fileKey, [])
+            pumpValue = fileValues[pumpId] if pumpId < len(fileValues) else defaultValue
+            if isinstance(defaultValue, tuple):
+                pumpValue = tuple(pumpValue)
+            pumpValues.append(pumpValue)
+        pumps.append(PumpRecord(*pumpValues))
+
+    return buildRecordsSnapshot(pumps, options, version)
+
+def buildRecordsSnapshot(pumps, options, version, previousSettings = None):
+    """
+    Build snapshot from list of pump records and options dictionary, both are changed.
+    Values of records that are the same object in previousSettings are reused, only changed pumps are converted
+    """
+    # stable id of each pump, position in list change when other pump is deleted. Pumps without id get next one, ids are never reused
+    nextUID = max([int(options['PumpNextUID'])] + [pump.uid + 1 for pump in pumps if isinstance(pump.uid, int)])
+    uidIndex = {}
+    for pumpId in range(len(pumps)):
+        if not isinstance(pumps[pumpId].uid, int) or pumps[pumpId].uid <= 0 or pumps[pumpId].uid in uidIndex:
+            pumps[pumpId] = pumps[pumpId]._replace(uid = nextUID)
+            nextUID += 1
+        uidIndex[pumps[pumpId].uid] = pumpId
+    options['PumpNextUID'] = nextUID
+
+    # position of each pump in previous settings if record did not change
+    previousIds = [None] * len(pumps)
+    if previousSettings is not None:
+        for pumpId in range(len(pumps)):
+            previousId = previousSettings.uidIndex.get(pumps[pumpId].uid)
+            if previousId is not None and previousSettings.pumps[previousId] is pumps[pumpId]:
+                previousIds[pumpId] = previousId
+
+    pumpMasks = []
+    pumpTimes = []
+    pumpPowers = []
+    for pumpId in range(len(pumps)):
+        if previousIds[pumpId] is not None:
+            pumpMasks.append(previousSettings.pumpMasks[previousIds[pumpId]])
+            pumpTimes.append(previousSettings.pumpTimes[previousIds[pumpId]])
+            pumpPowers.append(previousSettings.pumpPowers[previousIds[pumpId]])
+            continue
+
+        pumpValvesMask = []
+        for valvesList in [pumps[pumpId].needValves, pumps[pumpId].needValvesOn, pumps[pumpId].needValvesOff]:
+            valvesMask = 0
+            for sid in valvesList:
+                valvesMask |= 1 << sid
+            pumpValvesMask.append(valvesMask)
+        pumpMasks.append(tuple(pumpValvesMask))
+
+        # minimum on and off seconds of each pump
+        pumpTimes.append((parseMinTime(pumps[pumpId].minWorkingTime), parseMinTime(pumps[pumpId].minOffTime)))
+
+        # power of each pump, empty power is not counted
+        try:
+            pumpPowers.append(max(float(pumps[pumpId].power), 0.0))
+        except (TypeError, ValueError):
+            pumpPowers.append(0.0)
+
+    # valves index is kept if all pumps have same valves in same position
+    if previousSettings is not None and tuple(pumpMasks) == previousSettings.pumpMasks:
+        valvesIndex = previousSettings.valvesIndex
+    else:
+        valvesIndex = {}
+        for pumpId in range(len(pumps)):
+            for valvesList in [pumps[pumpId].needValves, pumps[pumpId].needValvesOn, pumps[pumpId].needValvesOff]:
+                for sid in valvesList:
+                    valvesIndex.setdefault(sid, set()).add(pumpId)
+
+        for sid in valvesIndex:
+            valvesIndex[sid] = frozenset(valvesIndex[sid])
+        valvesIndex = MappingProxyType(valvesIndex)
+
+    return SettingsSnapshot(version, tuple(pumps), MappingProxyType(options), valvesIndex, tuple(pumpMasks), tuple(pumpTimes), tuple(pumpPowers),
+                            tuple(pump.uid for pump in pumps), MappingProxyType(uidIndex))
+
+ListPayload = namedtuple('ListPayload', ['version', 'body', 'gzipBody', 'tag', 'lastModified'])
+
+listGzipMinSize = 512 # small answers are sent without compression
+
+def buildListPayload(localSettings):
+    """ Settings list in JSON, built once for each settings version and sent to all clients"""
+    listSettings = localSettings.to_dict()
+    for settingKey in secretSettingKeys:
+        del listSettings[settingKey]
+    listJSON = json.dumps(listSettings, sort_keys = True)
+    listBody = listJSON.encode('utf-8')
+
+    gzipBody = None
+    if len(listBody) >= listGzipMinSize:
+        gzipBody = gzip.compress(listBody, mtime = 0)
+
+    listTag = '"' + str(localSettings.version) + '-' + hashlib.md5(listBody).hexdigest() + '"'
+
+    return ListPayload(localSettings.version, listJSON, gzipBody, listTag, formatdate(usegmt = True))
+
+snapshotAdvPump = buildSettingsSnapshot(defaultSettingsAdvancePump, 0)
+listPayloadAdvPump = buildListPayload(snapshotAdvPump)
+mutexPublish = Lock()
+
+def publishSettings(settingsDict, pumpRecords = None):
+    """
+    Build new settings snapshot and replace current one, return new snapshot.
+    With pumpRecords, settingsDict only have options and only changed records are converted
+    """
+    global snapshotAdvPump, listPayloadAdvPump
+
+    with mutexPublish:
+        if pumpRecords is None:
+            newSnapshot = buildSettingsSnapshot(settingsDict, snapshotAdvPump.version + 1)
+        else:
+            newSnapshot = buildRecordsSnapshot(list(pumpRecords), dict(settingsDict), snapshotAdvPump.version + 1, snapshotAdvPump)
+        httpChanged = any(newSnapshot.options[configKey] != snapshotAdvPump.options[configKey] for configKey in httpConfigKeys)
+        mqttChanged = any(newSnapshot.options[configKey] != snapshotAdvPump.options[configKey] for configKey in mqttConfigKeys)
+        snapshotAdvPump = newSnapshot
+        listPayloadAdvPump = buildListPayload(newSnapshot)
+
+    if httpChanged:
+        setHTTPConfig(newSnapshot.options)
+    if mqttChanged:
+        setMQTTConfig(newSnapshot.options)
+
+    notifyStateChange()
+
+    return newSnapshot
+
+setHTTPConfig(snapshotAdvPump.options)
+
+PumpStateView = namedtuple('PumpStateView', ['slots', 'desired', 'switchOn', 'lastOnline', 'observedTime', 'health', 'switchTime'])
+PumpState = namedtuple('PumpState', ['desired', 'switchOn', 'lastOnline', 'observedTime', 'health', 'switchTime'])
+
+def healthPollPeriod(health : int, healthCount : int):
+    """ Seconds to next status request of pump in this health"""
+    if health == pumpSuspect:
+        return suspectPollPeriod
+    elif health == pumpRecovering:
+        return recoveringPollPeriod
+    elif health == pumpOffline:
+        backoff = min(offlineBackoffBase * 2 ** min(max(healthCount - healthSuspectFailures, 0), 16), offlineBackoffMax)
+        return backoff * random.uniform(1 - offlineBackoffJitter, 1 + offlineBackoffJitter)
+
+    return onlineCheckPeriod
+
+def nextPumpHealth(health : int, healthCount : int, isAnswer : bool):
+    """
+    Health after one status request, return new health and count.
+    Count is failed requests in suspect and off-line, answers in recovering.
+    """
+    if isAnswer:
+        if health == pumpOffline:
+            return pumpRecovering, 1
+        elif health == pumpRecovering and healthCount + 1 < healthRecoverAnswers:
+            return pumpRecovering, healthCount + 1
+        return pumpHealthy, 0
+
+    if health == pumpHealthy:
+        health, healthCount = pumpSuspect, 0
+    elif health == pumpRecovering:
+        # back to off-line, backoff start again
+        return pumpOffline, healthSuspectFailures
+
+    healthCount += 1
+    if health == pumpSuspect and healthCount >= healthSuspectFailures:
+        health = pumpOffline
+
+    return health, healthCount
+
+class PumpStateStore(object):
+    """
+    Runtime state of pumps in columns, each pump uid have one slot in all columns.
+    Booleans are byte arrays and times are float arrays with monotonic seconds, copy of one column is one memory copy.
+    Slots of deleted pumps are reused by new pumps, uid of pump do not change when other pump is deleted.
+    Store have is own lock, only kept to copy or change columns, never during device requests.
+    """
+
+    def __init__(self):
+        self.lock = TimedLock('state')
+        self.slots = MappingProxyType({}) # pump uid: slot, replaced in each change, readers keep reference without copy
+        self.freeSlots = []
+        self.desired = bytearray() # pump needed by valves
+        self.switchOn = bytearray() # relay state read from device
+        self.lastOnline = array('d') # last device answer
+        self.observedTime = array('d') # time of switchOn
+        self.switchTime = array('d') # time of answer that changed switchOn
+        self.health = bytearray() # pumpHealthy, pumpSuspect, pumpOffline or pumpRecovering
+        self.healthCount = array('I') # failed requests or answers in this health
+        self.nextPoll = array('d') # time of next status request
+        self.recovered = set() # pumps on-line again, commands are not sent while off-line
+
+    def sync(self, pumpUIDs):
+        """ Give slot to new pumps and free slots of deleted pumps"""
+        with self.lock:
+            slots = dict(self.slots)
+            for pumpUID in set(slots) - set(pumpUIDs):
+                self.freeSlots.append(slots.pop(pumpUID))
+
+            for pumpUID in pumpUIDs:
+                if pumpUID in slots:
+                    continue
+
+                if len(self.freeSlots) > 0:
+                    pumpSlot = self.freeSlots.pop()
+                else:
+                    pumpSlot = len(self.desired)
+                    self.desired.append(0)
+                    self.switchOn.append(0)
+                    self.lastOnline.append(0.0)
+                    self.observedTime.append(0.0)
+                    self.switchTime.append(0.0)
+                    self.health.append(0)
+                    self.healthCount.append(0)
+                    self.nextPoll.append(0.0)
+
+                # new pump is on-line until first status sweep, device state is unknown
+                self.desired[pumpSlot] = False
+                self.switchOn[pumpSlot] = False
+                self.lastOnline[pumpSlot] = monotonic()
+                self.observedTime[pumpSlot] = float('-inf')
+                self.switchTime[pumpSlot] = float('-inf')
+                self.health[pumpSlot] = pumpHealthy
+                self.healthCount[pumpSlot] = 0
+                self.nextPoll[pumpSlot] = monotonic()
+                slots[pumpUID] = pumpSlot
+
+            self.slots = MappingProxyType(slots)
+
+    def slot(self, pumpUID : int):
+        """ Slot of pump in columns, None if pump is deleted"""
+        return self.slots.get(pumpUID)
+
+    def read(self, pumpUID : int):
+        """ State of one pump, None if pump is deleted"""
+        with self.lock:
+            pumpSlot = self.slots.get(pumpUID)
+            if pumpSlot is None:
+                return None
+            return PumpState(bool(self.desired[pumpSlot]), bool(self.switchOn[pumpSlot]), self.lastOnline[pumpSlot], self.observedTime[pumpSlot], self.health[pumpSlot], self.switchTime[pumpSlot])
+
+    def snapshot(self):
+        """ Copy of all columns"""
+        with self.lock:
+            return PumpStateView(self.slots, bytes(self.desired), bytes(self.switchOn), self.lastOnline[:], self.observedTime[:], bytes(self.health), self.switchTime[:])
+
+    def copyDesired(self):
+        """ Slots and copy of desired column"""
+        with self.lock:
+            return self.slots, bytes(self.desired)
+
+    def setDesired(self, desiredStates):
+        """ Change desired state of pumps, dictionary of pump uid: state"""
+        with self.lock:
+            for pumpUID, pumpState in desiredStates.items():
+                pumpSlot = self.slots.get(pumpUID)
+                if pumpSlot is not None:
+                    self.desired[pumpSlot] = pumpState
+
+    def setObserved(self, observedStates, checkTime : float, pollPeriod = None):
+        """
+        Save devices answers, dictionary of pump uid: (request result, relay state). Pumps without answer keep last relay state.
+        pollPeriod is seconds to next status request of healthy pumps, for devices that publish their state.
+        Return list of (pump uid, is on-line) of pumps that become on-line or off-line
+        """
+        healthChanges = []
+
+        with self.lock:
+            for pumpUID, (resposeIsOk, isTurnOn) in observedStates.items():
+                # pump deleted during request
+                pumpSlot = self.slots.get(pumpUID)
+                if pumpSlot is None:
+                    continue
+
+                # pump without answer keep last confirmed relay state, only health show failed request
+                if resposeIsOk == 0:
+                    if bool(self.switchOn[pumpSlot]) != isTurnOn:
+                        self.switchTime[pumpSlot] = checkTime
+                    self.switchOn[pumpSlot] = isTurnOn
+                    self.lastOnline[pumpSlot] = checkTime
+                    self.observedTime[pumpSlot] = checkTime
+
+                wasOnline = self.health[pumpSlot] != pumpOffline
+                health, healthCount = nextPumpHealth(self.health[pumpSlot], self.healthCount[pumpSlot], resposeIsOk == 0)
+                self.health[pumpSlot] = health
+                self.healthCount[pumpSlot] = healthCount
+                if pollPeriod is not None and health == pumpHealthy:
+                    self.nextPoll[pumpSlot] = checkTime + pollPeriod
+                else:
+                    self.nextPoll[pumpSlot] = checkTime + healthPollPeriod(health, healthCount)
+
+                if wasOnline != (health != pumpOffline):
+                    healthChanges.append((pumpUID, health != pumpOffline))
+                    if health != pumpOffline:
+                        self.recovered.add(pumpUID)
+                    else:
+                        self.recovered.discard(pumpUID)
+
+        return healthChanges
+
+    def claimRecovered(self):
+        """ Pumps that answer again after off-line, each pump is returned once"""
+        with self.lock:
+            recoveredPumps = list(self.recovered)
+            self.recovered.clear()
+            return recoveredPumps
+
+    def claimPolls(self, checkTime : float):
+        """ Pumps that need status request now, next request is moved to avoid request them again before answer"""
+        with self.lock:
+            pollPumps = []
+            for pumpUID, pumpSlot in self.slots.items():
+                if self.nextPoll[pumpSlot] <= checkTime:
+                    pollPumps.append(pumpUID)
+                    self.nextPoll[pumpSlot] = checkTime + onlineCheckPeriod
+            return pollPumps
+
+    def pollBefore(self, pumpUID : int, pollTime : float):
+        """ Request status of pump not later than pollTime, even if it is off-line. Device answers before it move request again, connection is already open"""
+        with self.lock:
+            pumpSlot = self.slots.get(pumpUID)
+            if pumpSlot is not None and self.nextPoll[pumpSlot] > pollTime:
+                self.nextPoll[pumpSlot] = pollTime
+
+    def nextPollTime(self):
+        """ Time of first status request needed"""
+        with self.lock:
+            return min(self.nextPoll) if len(self.nextPoll) > 0 else monotonic() + onlineCheckPeriod
+
+stateAdvPump = PumpStateStore()
+
+# run history of pumps in memory, fixed size for each pump and without data-base
+historySamplePeriod = 5 # seconds between samples of pumps state
+historyEventsSize = 256 # last on, off, on-line and off-line changes of each pump
+historyResolutions = {'minute': (60, 1440), 'hour': (3600, 720), 'day': (86400, 366)} # name: (bucket seconds, buckets kept)
+historyEventNames = ('off', 'on', 'offline', 'online')
+
+class HistoryRing(object):
+    """
+    Run time, energy and on-line samples in buckets of one resolution. Bucket n is in slot n modulo size,
+    slot is cleared when a new bucket use it. Times are local seconds, day buckets start at local midnight
+    """
+    __slots__ = ('width', 'size', 'buckets', 'runTime', 'energy', 'samples', 'onlineSamples')
+
+    def __init__(self, width : int, size : int):
+        self.width = width
+        self.size = size
+        self.buckets = array('q', [-1]) * size # bucket number in slot, -1 if empty
+        self.runTime = array('d', [0.0]) * size # seconds pump on
+        self.energy = array('d', [0.0]) * size # PumpPower x hours on
+        self.samples = array('I', [0]) * size
+        self.onlineSamples = array('I', [0]) * size
+
+    def slot(self, bucket : int):
+        """ Slot of bucket, cleared if it has older bucket"""
+        bucketSlot = bucket % self.size
+        if self.buckets[bucketSlot] != bucket:
+            self.buckets[bucketSlot] = bucket
+            self.runTime[bucketSlot] = 0.0
+            self.energy[bucketSlot] = 0.0
+            self.samples[bucketSlot] = 0
+            self.onlineSamples[bucketSlot] = 0
+        return bucketSlot
+
+    def addRun(self, startTime : float, endTime : float, pumpPower : float):
+        """ Pump on from startTime to endTime, split by buckets"""
+        while startTime < endTime:
+            bucket = int(startTime // self.width)
+            bucketEnd = min((bucket + 1) * self.width, endTime)
+            bucketSlot = self.slot(bucket)
+            self.runTime[bucketSlot] += bucketEnd - startTime
+            self.energy[bucketSlot] += pumpPower * (bucketEnd - startTime) / 3600.0
+            startTime = bucketEnd
+
+    def addSample(self, sampleTime : float, isOnline : bool):
+        bucketSlot = self.slot(int(sampleTime // self.width))
+        self.samples[bucketSlot] += 1
+        if isOnline:
+            self.onlineSamples[bucketSlot] += 1
+
+    def query(self, lastBucket : int, count : int):
+        """ Columns of count buckets until lastBucket, older first. Buckets without data are zero"""
+        count = max(min(count, self.size), 0)
+        bucketSlots = [bucket % self.size for bucket in range(lastBucket - count + 1, lastBucket + 1)]
+        isValid = [self.buckets[bucketSlot] == bucket for bucketSlot, bucket in zip(bucketSlots, range(lastBucket - count + 1, lastBucket + 1))]
+
+        return {'runTime': [self.runTime[bucketSlot] if valid else 0.0 for bucketSlot, valid in zip(bucketSlots, isValid)],
+                'energy': [self.energy[bucketSlot] if valid else 0.0 for bucketSlot, valid in zip(bucketSlots, isValid)],
+                'availability': [float(self.onlineSamples[bucketSlot]) / self.samples[bucketSlot] if valid and self.samples[bucketSlot] > 0 else None for bucketSlot, valid in zip(bucketSlots, isValid)]}
+
+class PumpHistory(object):
+    """
+    History of one pump, ring of last changes and rings of each resolution
+    """
+    __slots__ = ('eventTimes', 'eventTypes', 'eventNext', 'eventCount', 'rings', 'isOn', 'isOnline')
+
+    def __init__(self):
+        self.eventTimes = array('d', [0.0]) * historyEventsSize # epoch seconds
+        self.eventTypes = bytearray(historyEventsSize) # index of historyEventNames
+        self.eventNext = 0
+        self.eventCount = 0
+        self.rings = dict((resolution, HistoryRing(*historyResolutions[resolution])) for resolution in historyResolutions)
+        self.isOn = False
+        self.isOnline = True
+
+    def addEvent(self, eventTime : float, eventType : int):
+        self.eventTimes[self.eventNext] = eventTime
+        self.eventTypes[self.eventNext] = eventType
+        self.eventNext = (self.eventNext + 1) % historyEventsSize
+        self.eventCount = min(self.eventCount + 1, historyEventsSize)
+
+    def events(self):
+        """ Changes as (epoch time, event name), older first"""
+        firstEvent = (self.eventNext - self.eventCount) % historyEventsSize
+        eventIdxs = [(firstEvent + eventIdx) % historyEventsSize for eventIdx in range(self.eventCount)]
+        return [(self.eventTimes[eventIdx], historyEventNames[self.eventTypes[eventIdx]]) for eventIdx in eventIdxs]
+
+class PumpHistoryStore(object):
+    """
+    Run history of all pumps by uid, written by control thread in each sample and read by history page.
+    Run time is split in changes of device state with time of device answer, not only in sample time
+    """
+
+    def __init__(self):
+        self.lock = TimedLock('history')
+        self.pumps = {} # pump uid: PumpHistory
+        self.lastSample = None # monotonic time of last sample
+
+    def sample(self, localSettings, localState, checkTime : float):
+        """ Save run time since last sample and changes of pumps, localState is store snapshot"""
+        wallNow = datetime.now().astimezone()
+        epochOffset = wallNow.timestamp() - checkTime # monotonic to epoch
+        localOffset = epochOffset + wallNow.utcoffset().total_seconds() # monotonic to local seconds
+        lastSample = self.lastSample if self.lastSample is not None else checkTime
+
+        with self.lock:
+            # pumps deleted or added in settings
+            for pumpUID in set(self.pumps) - set(localSettings.pumpUIDs):
+                del self.pumps[pumpUID]
+
+            for pumpId in range(len(localSettings.pumps)):
+                pumpUID = localSettings.pumpUIDs[pumpId]
+                pumpSlot = localState.slots.get(pumpUID)
+                if pumpSlot is None:
+                    continue
+
+                pumpHistory = self.pumps.get(pumpUID)
+                if pumpHistory is None:
+                    pumpHistory = self.pumps[pumpUID] = PumpHistory()
+
+                isOn = bool(localState.switchOn[pumpSlot])
+                isOnline = localState.health[pumpSlot] != pumpOffline
+                pumpPower = localSettings.pumpPowers[pumpId]
+
+                # change time is time of device answer that change state, later answers do not move it
+                changeTime = checkTime
+                if isOn != pumpHistory.isOn:
+                    changeTime = min(max(localState.switchTime[pumpSlot], lastSample), checkTime)
+                    pumpHistory.addEvent(changeTime + epochOffset, int(isOn))
+
+                for ring in pumpHistory.rings.values():
+                    if pumpHistory.isOn:
+                        ring.addRun(lastSample + localOffset, changeTime + localOffset, pumpPower)
+                    if isOn:
+                        ring.addRun(changeTime + localOffset, checkTime + localOffset, pumpPower)
+                    ring.addSample(checkTime + localOffset, isOnline)
+
+                if isOnline != pumpHistory.isOnline:
+                    pumpHistory.addEvent(checkTime + epochOffset, 2 + int(isOnline))
+
+                pumpHistory.isOn = isOn
+                pumpHistory.isOnline = isOnline
+
+            self.lastSample = checkTime
+
+    def query(self, localSettings, resolution : str, count : int, pumpIds):
+        """ Buckets of resolution for pumps in list position pumpIds, with totals and last changes"""
+        bucketWidth = historyResolutions[resolution][0]
+        wallNow = datetime.now().astimezone()
+        lastBucket = int((wallNow.timestamp() + wallNow.utcoffset().total_seconds()) // bucketWidth)
+        count = max(min(count, historyResolutions[resolution][1]), 0)
+
+        historyPumps = []
+        with self.lock:
+            for pumpId in pumpIds:
+                pumpHistory = self.pumps.get(localSettings.pumpUIDs[pumpId])
+                if pumpHistory is None:
+                    continue
+
+                pumpBuckets = pumpHistory.rings[resolution].query(lastBucket, count)
+                historyPumps.append({'id': pumpId, 'uid': localSettings.pumpUIDs[pumpId], 'name': localSettings.pumps[pumpId].name, 'power': localSettings.pumpPowers[pumpId],
+                                     'isOn': pumpHistory.isOn, 'buckets': pumpBuckets, 'totalRunTime': sum(pumpBuckets['runTime']), 'totalEnergy': sum(pumpBuckets['energy']),
+                                     'events': pumpHistory.events()})
+
+        # start of buckets in epoch seconds, same for all pumps
+        bucketStarts = [bucket * bucketWidth - wallNow.utcoffset().total_seconds() for bucket in range(lastBucket - count + 1, lastBucket + 1)]
+
+        return {'resolution': resolution, 'width': bucketWidth, 'starts': bucketStarts, 'pumps': historyPumps}
+
+historyAdvPump = PumpHistoryStore()
+
+# error type of each request result, for metrics
+httpErrorTypes = {1: 'timeout', 2: 'redirects', 3: 'request', 4: 'parse', 5: 'status'}
+
+def requestHTTP(commandURL, deviceHost):
     resposeIsOk = -1
     response = None
+    requestStart = monotonic()
+    loadHTTPStack()
 
     try:
-        response = requests.get(commandURL)
-        resposeIsOk = 0
+        httpResponse = getDeviceSession(deviceHost).get(commandURL, timeout = getHTTPTimeout())
 
-        response = response.json()
-    except requests.exceptions.Timeout:
+        if httpResponse.status_code < 200 or httpResponse.status_code >= 300:
+            # device refuse command, like Gen2 RPC errors with JSON code and message
+            resposeIsOk = 5
+            print("Advance pump error answer from", deviceHost, httpResponse.status_code, httpResponse.text[:200])
+        else:
+            try:
+                response = httpResponse.json()
+                resposeIsOk = 0
+            except ValueError:
+                # device answer but not in JSON
+                resposeIsOk = 4
+                print("Advance pump invalid answer from", deviceHost)
+    except (requests.exceptions.Timeout, requests.exceptions.RetryError):
         # Maybe set up for a retry, or continue in a retry loop
         resposeIsOk = 1
-        print("Connection time out")
+        print("Advance pump connection time out", deviceHost)
     except requests.exceptions.TooManyRedirects:
         # Tell the user their URL was bad and try a different one
         resposeIsOk = 2
-        print("Too many redirections")
+        print("Advance pump too many redirections", deviceHost)
     except requests.exceptions.RequestException as e:
         # catastrophic error. bail.
         #raise SystemExit(e)
         resposeIsOk = 3
-        print("Fatal error")
+        print("Advance pump request error", deviceHost, e)
+
+    observeMetric('advance_pump_http_seconds', monotonic() - requestStart, (('device', deviceHost),))
+    if resposeIsOk != 0:
+        countMetric('advance_pump_http_errors_total', (('device', deviceHost), ('type', httpErrorTypes[resposeIsOk])))
 
     return resposeIsOk, response
 
-def pumpIsOnLine(deviceType : str, pumpIP : str):
-    resposeIsOk = -1
-    isTurnOn = False
+def splitPumpAddress(pumpIP : str):
+    """ Pump address is device host and optional relay channel, 'host#channel', channel 0 by default"""
+    deviceHost, _, channel = pumpIP.strip().partition(u"#")
+    try:
+        channel = int(channel) if channel else 0
+    except ValueError:
+        channel = 0
+
+    return deviceHost, channel
+
+class PumpDriver(object):
+    """
+    Base of devices drivers, one driver for each PumpDeviceType.
+    Drivers that read many relays in one request group pumps by device host.
+    """
+    label = u""
+    multiChannel = False
+    supportsLease = False # device turn off relay after leaseTime seconds if not renewed
+
+    def get_status(self, pumpIP : str):
+        """ Return request result (0 if ok) and relay state"""
+        return -1, False
+
+    def set_state(self, pumpIP : str, setState : bool, leaseTime : int = 0):
+        """ Return request result (0 if ok) and relay state confirmed by device. Turn on with leaseTime > 0 set device auto-off"""
+        return -1, False
+
+    def renew_leases(self, pumpIPs, leaseTime : int):
+        """ Turn on again with new auto-off time, dictionary of address to (request result, relay state)"""
+        pumpsStatus = {}
+        for pumpIP in pumpIPs:
+            pumpsStatus[pumpIP] = self.set_state(pumpIP, True, leaseTime)
+        return pumpsStatus
+
+    def batch_get_status(self, pumpIPs):
+        """ Status of many pumps, dictionary of address to (request result, relay state)"""
+        pumpsStatus = {}
+        for pumpIP in pumpIPs:
+            pumpsStatus[pumpIP] = self.get_status(pumpIP)
+        return pumpsStatus
+
+    def mqtt_topics(self, mqttId : str, pumpIP : str):
+        """ MQTT topics of relay state and of device on-line, None if device do not publish state"""
+        return None
+
+    def mqtt_state(self, payload : bytes):
+        """ Relay state in status message, None if message have no state"""
+        return None
+
+    def mqtt_command(self, mqttId : str, pumpIP : str, setState : bool, leaseTime : int):
+        """ Topic and payload of command, None to send command by HTTP"""
+        return None
+
+    def mqtt_refresh(self, mqttId : str):
+        """ Topic and payload that ask device to publish is state, None if not possible"""
+        return None
+
+    def group_key(self, pumpIP : str):
+        """ Pumps with same key are read in same batch"""
+        if self.multiChannel:
+            return splitPumpAddress(pumpIP)[0]
+        return pumpIP
+
+class ShellyGen1Driver(PumpDriver):
+    """
+    Shelly first generation (Shelly 1, 1PM, 2.5), HTTP API /status and /relay/<channel>
+    """
+    label = u"Shelly 1"
+    multiChannel = True
+    supportsLease = True
+
+    def get_status(self, pumpIP : str):
+        return self.batch_get_status([pumpIP])[pumpIP]
+
+    def set_state(self, pumpIP : str, setState : bool, leaseTime : int = 0):
+        deviceHost, channel = splitPumpAddress(pumpIP)
+        commandURL = u"http://" + deviceHost + u"/relay/" + str(channel) + (u"?turn=on" if setState else u"?turn=off")
+        if setState and leaseTime > 0:
+            commandURL += u"&timer=" + str(int(leaseTime))
+
+        resposeIsOk, response = requestHTTP(commandURL, deviceHost)
+
+        try:
+            return resposeIsOk, resposeIsOk == 0 and bool(response['ison'])
+        except (KeyError, TypeError):
+            return 4, False
+
+    def batch_get_status(self, pumpIPs):
+        pumpsStatus = {}
+        devicesStatus = {}
+
+        for pumpIP in pumpIPs:
+            deviceHost, channel = splitPumpAddress(pumpIP)
+
+            # one request for all relays of device
+            if deviceHost not in devicesStatus:
+                devicesStatus[deviceHost] = requestHTTP(u"http://" + deviceHost + u"/status", deviceHost)
+            resposeIsOk, response = devicesStatus[deviceHost]
+
+            try:
+                pumpsStatus[pumpIP] = (resposeIsOk, resposeIsOk == 0 and bool(response['relays'][channel]['ison']))
+            except (KeyError, IndexError, TypeError):
+                pumpsStatus[pumpIP] = (4, False)
+
+        return pumpsStatus
+
+    def mqtt_topics(self, mqttId : str, pumpIP : str):
+        return mqttId + u"/relay/" + str(splitPumpAddress(pumpIP)[1]), mqttId + u"/online"
+
+    def mqtt_state(self, payload : bytes):
+        # other payloads are like overpower
+        if payload in (b"on", b"off"):
+            return payload == b"on"
+        return None
+
+    def mqtt_command(self, mqttId : str, pumpIP : str, setState : bool, leaseTime : int):
+        # MQTT command have no auto-off timer, lease is sent by HTTP
+        if setState and leaseTime > 0:
+            return None
+        return mqttId + u"/relay/" + str(splitPumpAddress(pumpIP)[1]) + u"/command", (u"on" if setState else u"off")
+
+    def mqtt_refresh(self, mqttId : str):
+        return mqttId + u"/command", u"update"
+
+class ShellyGen2Driver(PumpDriver):
+    """
+    Shelly second generation (Plus, Pro), RPC API Switch.Set and Shelly.GetStatus with all switches
+    """
+    label = u"Shelly Plus/Pro (Gen2)"
+    multiChannel = True
+    supportsLease = True
+
+    def get_status(self, pumpIP : str):
+        deviceHost, channel = splitPumpAddress(pumpIP)
+
+        resposeIsOk, response = requestHTTP(u"http://" + deviceHost + u"/rpc/Switch.GetStatus?id=" + str(channel), deviceHost)
+
+        try:
+            return resposeIsOk, resposeIsOk == 0 and bool(response['output'])
+        except (KeyError, TypeError):
+            return 4, False
+
+    def set_state(self, pumpIP : str, setState : bool, leaseTime : int = 0):
+        deviceHost, channel = splitPumpAddress(pumpIP)
+        commandURL = u"http://" + deviceHost + u"/rpc/Switch.Set?id=" + str(channel) + (u"&on=true" if setState else u"&on=false")
+        if setState and leaseTime > 0:
+            commandURL += u"&toggle_after=" + str(int(leaseTime))
 
-    if deviceType == 'shelly1':
-        commandURL = u"http://" + pumpIP + u"/status"
-        response = None
+        resposeIsOk, response = requestHTTP(commandURL, deviceHost)
 
-        resposeIsOk, response = requestHTTP(commandURL)
+        # answer only have previous state, device is in new state if command is accepted
+        if resposeIsOk == 0 and not (isinstance(response, dict) and 'was_on' in response):
+            return 4, False
+        return resposeIsOk, resposeIsOk == 0 and setState
+
+    def batch_get_status(self, pumpIPs):
+        if len(pumpIPs) == 1:
+            return {pumpIPs[0]: self.get_status(pumpIPs[0])}
+
+        pumpsStatus = {}
+        devicesStatus = {}
+
+        for pumpIP in pumpIPs:
+            deviceHost, channel = splitPumpAddress(pumpIP)
+
+            # one request with all switches of device
+            if deviceHost not in devicesStatus:
+                devicesStatus[deviceHost] = requestHTTP(u"http://" + deviceHost + u"/rpc/Shelly.GetStatus", deviceHost)
+            resposeIsOk, response = devicesStatus[deviceHost]
+
+            try:
+                pumpsStatus[pumpIP] = (resposeIsOk, resposeIsOk == 0 and bool(response['switch:' + str(channel)]['output']))
+            except (KeyError, TypeError):
+                pumpsStatus[pumpIP] = (4, False)
+
+        return pumpsStatus
+
+    def mqtt_topics(self, mqttId : str, pumpIP : str):
+        return mqttId + u"/status/switch:" + str(splitPumpAddress(pumpIP)[1]), mqttId + u"/online"
+
+    def mqtt_state(self, payload : bytes):
+        try:
+            return bool(json.loads(payload)['output'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def mqtt_command(self, mqttId : str, pumpIP : str, setState : bool, leaseTime : int):
+        commandParams = {'id': splitPumpAddress(pumpIP)[1], 'on': setState}
+        if setState and leaseTime > 0:
+            commandParams['toggle_after'] = int(leaseTime)
+        return mqttId + u"/rpc", json.dumps({'id': 1, 'src': mqttClientId, 'method': 'Switch.Set', 'params': commandParams})
+
+    def mqtt_refresh(self, mqttId : str):
+        return mqttId + u"/command", u"status_update"
+
+class HTTPJSONDriver(PumpDriver):
+    """
+    Generic device, address is base URL. Status is GET base URL with JSON answer with 'ison', 'on' or 'output',
+    change state is GET base URL with '?turn=on' or '?turn=off'
+    """
+    label = u"Generic HTTP/JSON"
+    stateKeys = ['ison', 'on', 'output']
+
+    def baseURL(self, pumpIP : str):
+        pumpIP = pumpIP.strip()
+        if not pumpIP.startswith(u"http://"):
+            pumpIP = u"http://" + pumpIP
+        return pumpIP
+
+    def deviceHost(self, pumpIP : str):
+        return self.baseURL(pumpIP)[len(u"http://"):].split(u"/")[0]
+
+    def get_status(self, pumpIP : str):
+        resposeIsOk, response = requestHTTP(self.baseURL(pumpIP), self.deviceHost(pumpIP))
 
         if resposeIsOk == 0:
-            isTurnOn = bool(response['relays'][0]['ison'])
-    else:
-        pass
-        # TODO: another supported device
+            for stateKey in self.stateKeys:
+                if isinstance(response, dict) and stateKey in response:
+                    return resposeIsOk, bool(response[stateKey])
+            return 4, False
 
-    return resposeIsOk, isTurnOn
+        return resposeIsOk, False
 
-def pupmpAction(deviceType : str, pumpIP : str, setState : bool):
-    resposeIsOk = -1
+    def set_state(self, pumpIP : str, setState : bool, leaseTime : int = 0):
+        commandURL = self.baseURL(pumpIP) + (u"?turn=on" if setState else u"?turn=off")
+
+        resposeIsOk, response = requestHTTP(commandURL, self.deviceHost(pumpIP))
+
+        if resposeIsOk == 0:
+            for stateKey in self.stateKeys:
+                if isinstance(response, dict) and stateKey in response:
+                    return resposeIsOk, bool(response[stateKey])
 
-    if deviceType == 'shelly1':
-        if setState:
-            commandURL = u"http://" + pumpIP + u"/relay/0?turn=on"
+        return resposeIsOk, resposeIsOk == 0 and setState
+
+# device drivers by PumpDeviceType, other plugins could add more drivers
+pumpDrivers = {}
+
+def registerPumpDriver(deviceType : str, driver : PumpDriver):
+    pumpDrivers[deviceType] = driver
+
+def getPumpDriver(deviceType : str):
+    return pumpDrivers.get(deviceType)
+
+registerPumpDriver('shelly1', ShellyGen1Driver())
+registerPumpDriver('shellygen2', ShellyGen2Driver())
+registerPumpDriver('http_json', HTTPJSONDriver())
+
+def pumpIsOnLine(deviceType : str, pumpIP : str):
+    driver = getPumpDriver(deviceType)
+    if driver is None:
+        return -1, False
+
+    return driver.get_status(pumpIP)
+
+def pupmpAction(deviceType : str, pumpIP : str, setState : bool, leaseTime : int = 0, mqttId : str = u""):
+    driver = getPumpDriver(deviceType)
+    if driver is None:
+        return -1, False
+
+    if not driver.supportsLease:
+        leaseTime = 0
+
+    # command by MQTT if device publish its state, by HTTP if it is not confirmed
+    localTransport = mqttTransport
+    if mqttId != u"" and localTransport is not None:
+        mqttState = localTransport.command(driver, mqttId, pumpIP, setState, leaseTime)
+        if mqttState is not None:
+            return 0, mqttState
+
+    return driver.set_state(pumpIP, setState, leaseTime)
+
+# MQTT transport, devices with PumpMQTTId publish relay state and receive commands. Status requests are only fallback
+mqttConfigKeys = ['PumpMQTTHost', 'PumpMQTTPort', 'PumpMQTTUser', 'PumpMQTTPassword']
+mqttClientId = u"sip-advance-pump-%06x" % random.getrandbits(24)
+mqttKeepAlive = 60 # seconds between keep alive messages of broker connection
+mqttPollPeriod = 300 # seconds between status requests of healthy pumps that publish state
+mqttCommandTimeout = 2.0 # seconds to wait device state after command, then command is sent by HTTP
+mqttBackoffBase = 1 # seconds to first reconnect, double in each failure
+mqttBackoffMax = 60 # maximum seconds between connections
+mqttTransport = None
+mutexMQTT = Lock()
+
+def createMQTTClient(clientId : str):
+    """ paho-mqtt client, imported only if MQTT is used"""
+    import paho.mqtt.client as mqttClient
+
+    if hasattr(mqttClient, 'CallbackAPIVersion'):
+        return mqttClient.Client(mqttClient.CallbackAPIVersion.VERSION1, clientId)
+    return mqttClient.Client(clientId)
+
+# other client could be used, like a broker stand-in in tests
+mqttClientFactory = createMQTTClient
+
+class MQTTTransport(object):
+    """
+    Connection to MQTT broker in own thread, reconnect with exponential backoff.
+    Relay state messages are saved in state store like status answers and move next status request to mqttPollPeriod.
+    Commands are published and confirmed by state message of device
+    """
+
+    def __init__(self, mqttConfig):
+        self.mqttConfig = mqttConfig
+        self.client = None
+        self.connected = False
+        self.running = True
+        self.stopEvent = Event()
+        self.topics = {} # topic: (topic type, driver, pump uids), replaced when settings change
+        self.settingsVersion = None # settings of subscribed topics
+        self.waiters = {} # state topic: list of (state, event) of commands waiting confirmation
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop without wait, thread end after current loop"""
+        self.running = False
+        self.stopEvent.set()
+        localClient = self.client
+        if localClient is not None:
+            localClient.disconnect()
+
+    def run(self):
+        reconnectDelay = mqttBackoffBase
+
+        while self.running:
+            try:
+                client = mqttClientFactory(mqttClientId)
+            except ImportError:
+                print("Advance pump MQTT need paho-mqtt, devices use only HTTP")
+                return
+
+            client.on_connect = self.onConnect
+            client.on_message = self.onMessage
+            if self.mqttConfig['PumpMQTTUser'] != u"":
+                client.username_pw_set(self.mqttConfig['PumpMQTTUser'], self.mqttConfig['PumpMQTTPassword'])
+
+            try:
+                client.connect(self.mqttConfig['PumpMQTTHost'].strip(), int(self.mqttConfig['PumpMQTTPort']), mqttKeepAlive)
+                self.client = client
+
+                # topics are subscribed in connect answer, loop end when connection is lost
+                while self.running and client.loop(1.0) == 0:
+                    if self.connected:
+                        reconnectDelay = mqttBackoffBase
+                        self.syncTopics()
+            except (OSError, ValueError) as e:
+                countMetric('advance_pump_mqtt_connects_total', (('result', 'error'),))
+                print("Advance pump MQTT connection error", self.mqttConfig['PumpMQTTHost'], e)
+
+            self.setDisconnected()
+            try:
+                client.disconnect()
+            except (OSError, ValueError):
+                pass
+
+            if self.running:
+                self.stopEvent.wait(reconnectDelay * random.uniform(1 - offlineBackoffJitter, 1 + offlineBackoffJitter))
+                reconnectDelay = min(reconnectDelay * 2, mqttBackoffMax)
+
+    def onConnect(self, client, userdata, flags, rc):
+        if rc != 0:
+            countMetric('advance_pump_mqtt_connects_total', (('result', 'refused'),))
+            print("Advance pump MQTT connection refused", rc)
+            return
+
+        countMetric('advance_pump_mqtt_connects_total', (('result', 'ok'),))
+
+        # new session, all topics are subscribed again
+        self.topics = {}
+        self.settingsVersion = None
+        self.connected = True
+
+    def setDisconnected(self):
+        """ Pumps that publish state are polled again, until connection is back"""
+        wasConnected = self.connected
+        self.connected = False
+        self.client = None
+
+        if wasConnected:
+            pollTime = monotonic()
+            for topicType, driver, pumpUIDs in self.topics.values():
+                for pumpUID in pumpUIDs:
+                    stateAdvPump.pollBefore(pumpUID, pollTime)
+            wakeControlLoop()
+
+    def syncTopics(self):
+        """ Subscribe topics of pumps in settings, new devices are asked to publish state"""
+        localSettings = snapshotAdvPump
+        if localSettings.version == self.settingsVersion:
+            return
+
+        newTopics = {}
+        refreshMessages = {}
+        for pump in localSettings.pumps:
+            driver = getPumpDriver(pump.deviceType)
+            mqttId = pump.mqttId.strip()
+            if driver is None or mqttId == u"":
+                continue
+
+            pumpTopics = driver.mqtt_topics(mqttId, pump.ip)
+            if pumpTopics is None:
+                continue
+
+            # device on-line topic is same for all relays of device
+            for topic, topicType in zip(pumpTopics, ('state', 'online')):
+                newTopics[topic] = (topicType, driver, newTopics[topic][2] + (pump.uid,) if topic in newTopics else (pump.uid,))
+
+            if pumpTopics[0] not in self.topics:
+                refreshMessage = driver.mqtt_refresh(mqttId)
+                if refreshMessage is not None:
+                    refreshMessages[refreshMessage[0]] = refreshMessage[1]
+
+        for topic in set(self.topics) - set(newTopics):
+            self.client.unsubscribe(topic)
+        for topic in set(newTopics) - set(self.topics):
+            self.client.subscribe(topic)
+        self.topics = newTopics
+        self.settingsVersion = localSettings.version
+
+        for topic in refreshMessages:
+            self.client.publish(topic, refreshMessages[topic])
+
+    def onMessage(self, client, userdata, message):
+        topicInfo = self.topics.get(message.topic)
+        if topicInfo is None:
+            return
+        topicType, driver, pumpUIDs = topicInfo
+
+        if topicType == 'online':
+            # on-line message is not relay state, last will of device is false
+            if message.payload.strip() != b"false":
+                return
+            observedState = (1, False)
+        else:
+            pumpState = driver.mqtt_state(message.payload)
+            if pumpState is None:
+                return
+            observedState = (0, pumpState)
+
+            with self.lock:
+                for waitState, waitEvent in self.waiters.get(message.topic, ()):
+                    if waitState == pumpState:
+                        waitEvent.set()
+
+        countMetric('advance_pump_mqtt_messages_total', (('type', topicType),))
+        logHealthChanges(stateAdvPump.setObserved(dict((pumpUID, observedState) for pumpUID in pumpUIDs), monotonic(), mqttPollPeriod))
+        notifyStateChange()
+
+    def pushedPumps(self):
+        """ Uid of pumps with subscribed state topic, empty if not connected"""
+        if not self.connected:
+            return frozenset()
+        return frozenset(pumpUID for topicType, driver, pumpUIDs in self.topics.values() if topicType == 'state' for pumpUID in pumpUIDs)
+
+    def command(self, driver, mqttId : str, pumpIP : str, setState : bool, leaseTime : int):
+        """ Publish command and wait device state, return state or None if command must be sent by HTTP"""
+        localClient = self.client
+        if not self.connected or localClient is None:
+            return None
+
+        mqttCommand = driver.mqtt_command(mqttId, pumpIP, setState, leaseTime)
+        pumpTopics = driver.mqtt_topics(mqttId, pumpIP)
+        if mqttCommand is None or pumpTopics is None or pumpTopics[0] not in self.topics:
+            return None
+
+        commandWaiter = (setState, Event())
+        with self.lock:
+            self.waiters.setdefault(pumpTopics[0], []).append(commandWaiter)
+
+        try:
+            if localClient.publish(mqttCommand[0], mqttCommand[1]).rc != 0:
+                return None
+            countMetric('advance_pump_mqtt_messages_total', (('type', 'command'),))
+
+            if commandWaiter[1].wait(mqttCommandTimeout):
+                return setState
+            return None
+        finally:
+            with self.lock:
+                self.waiters[pumpTopics[0]].remove(commandWaiter)
+                if len(self.waiters[pumpTopics[0]]) == 0:
+                    del self.waiters[pumpTopics[0]]
+
+def setMQTTConfig(localSettings):
+    """ Connect to new broker, old connection is closed in background. Empty host use only HTTP"""
+    global mqttTransport
+
+    with mutexMQTT:
+        if mqttTransport is not None:
+            mqttTransport.stop()
+            mqttTransport = None
+
+        if localSettings['PumpMQTTHost'].strip() != u"" and isRuning:
+            mqttTransport = MQTTTransport(dict((configKey, localSettings[configKey]) for configKey in mqttConfigKeys))
+            mqttTransport.start()
+
+def getMQTTPumps():
+    """ Uid of pumps that publish state to connected broker"""
+    localTransport = mqttTransport
+    if localTransport is None:
+        return frozenset()
+    return localTransport.pushedPumps()
+
+def stopMQTT(timeout):
+    """ Close broker connection and wait thread"""
+    global mqttTransport
+
+    with mutexMQTT:
+        localTransport = mqttTransport
+        mqttTransport = None
+
+    if localTransport is not None:
+        localTransport.stop()
+        if localTransport.thread is not None:
+            localTransport.thread.join(timeout)
+
+def startPumpsSweep(localSettings, pollPumps = None):
+    """
+    Send status request to pumps in parallel, one request for pumps in same device, return the futures of the sweep.
+    Only devices with one pump in pollPumps are requested, all pumps if it is None
+    """
+    sweepFutures = []
+
+    # group pumps by driver and device
+    sweepGroups = {}
+    for pump in localSettings.pumps:
+        driver = getPumpDriver(pump.deviceType)
+        if driver is None:
+            continue
+        sweepGroups.setdefault((pump.deviceType, driver.group_key(pump.ip)), []).append(pump)
+
+    # other pumps of device are in same answer
+    if pollPumps is not None:
+        pollPumps = set(pollPumps)
+        sweepGroups = dict((groupKey, groupPumps) for groupKey, groupPumps in sweepGroups.items() if any(pump.uid in pollPumps for pump in groupPumps))
+
+    sweepPending = [len(sweepGroups)]
+    sweepLock = Lock()
+
+    def onPumpAnswer(future):
+        # wake control thread only when last device answer
+        with sweepLock:
+            sweepPending[0] -= 1
+            lastAnswer = sweepPending[0] == 0
+
+        if lastAnswer:
+            wakeControlLoop()
+
+    for (deviceType, groupKey), groupPumps in sweepGroups.items():
+        pumpIPs = [pump.ip for pump in groupPumps]
+        future = poolAdvPump.submit(getPumpDriver(deviceType).batch_get_status, pumpIPs)
+        sweepFutures.append((future, [pump.uid for pump in groupPumps], pumpIPs))
+
+    for future, pumpUIDs, pumpIPs in sweepFutures:
+        future.add_done_callback(onPumpAnswer)
+
+    return sweepFutures
+
+def sweepIsFinished(sweepFutures, sweepStart):
+    """ Sweep is finished when all devices answer or deadline is over"""
+    if monotonic() - sweepStart > getSweepDeadline():
+        return True
+
+    for future, pumpUIDs, pumpIPs in sweepFutures:
+        if not future.done():
+            return False
+
+    return True
+
+def applyPumpsSweep(sweepFutures):
+    """ Save on-line and switch state from finished sweep, devices without answer count as off-line"""
+    global stateAdvPump
+
+    sweepResults = {}
+    for future, pumpUIDs, pumpIPs in sweepFutures:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            groupStatus = future.result()
+        else:
+            # no answer until deadline
+            future.cancel()
+            groupStatus = {}
+
+        for pumpUID, pumpIP in zip(pumpUIDs, pumpIPs):
+            sweepResults[pumpUID] = groupStatus.get(pumpIP, (1, False))
+
+    # pumps that publish state by MQTT are requested again only as fallback
+    checkTime = monotonic()
+    pushedPumps = getMQTTPumps()
+    logHealthChanges(stateAdvPump.setObserved(dict((pumpUID, sweepResults[pumpUID]) for pumpUID in sweepResults if pumpUID not in pushedPumps), checkTime))
+    logHealthChanges(stateAdvPump.setObserved(dict((pumpUID, sweepResults[pumpUID]) for pumpUID in sweepResults if pumpUID in pushedPumps), checkTime, mqttPollPeriod))
+
+    notifyStateChange()
+
+def logHealthChanges(healthChanges):
+    """ Save pumps that become on-line or off-line to logs in DB, control thread reconcile pumps on-line again"""
+    if any(isOnline for pumpUID, isOnline in healthChanges):
+        wakeControlLoop()
+
+    localSettings = snapshotAdvPump
+    if len(healthChanges) == 0 or not withDBLogger or not localSettings.options['PumpDBLog']:
+        return
+
+    changeDate = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for pumpUID, isOnline in healthChanges:
+        if pumpUID in localSettings.uidIndex:
+            queueDBEvent('log', localSettings.pumps[localSettings.uidIndex[pumpUID]].name, [changeDate, u"on-line" if isOnline else u"off-line"])
+
+def getStateSignature():
+    """ Values of pumps status shown to clients, except last seen time that change in each device answer"""
+    localState = stateAdvPump.snapshot()
+    return (snapshotAdvPump.version, tuple(sorted(localState.slots.items())), localState.switchOn, localState.health,
+            tuple(sorted(advancePumpManualMode.items())), runningPower, queuedPower)
+
+def notifyStateChange():
+    """ Pumps state could change, new version only if clients see a different state. Waiting web clients check it"""
+    global stateVersionAdvPump, stateSignatureAdvPump
+
+    with stateChangedAdvPump:
+        stateSignature = getStateSignature()
+        if stateSignature != stateSignatureAdvPump:
+            stateSignatureAdvPump = stateSignature
+            stateVersionAdvPump += 1
+        stateChangedAdvPump.notify_all()
+
+def waitStateChange(knownVersion, timeout):
+    """
+    Wait until state version is different of known version or timeout, return current version.
+    Return None without wait if client know current version and cannot wait, too many clients waiting or plugin stopping
+    """
+    global stateWaiters
+
+    with stateChangedAdvPump:
+        if stateVersionAdvPump == knownVersion:
+            if stateWaiters >= stateMaxWaiters or not isRuning:
+                return None
+            stateWaiters += 1
+            stateChangedAdvPump.wait_for(lambda: stateVersionAdvPump != knownVersion or not isRuning, timeout)
+            stateWaiters -= 1
+        currentVersion = stateVersionAdvPump
+
+    return currentVersion
+
+def getPumpsStatus():
+    """ On-line, switch and manual state of all pumps, in one structure to send to home page"""
+    global stateAdvPump, advancePumpManualMode
+
+    localSettings = snapshotAdvPump
+    checkTime = monotonic()
+    currentDatime = datetime.now()
+    stateVersion = stateVersionAdvPump
+
+    localState = stateAdvPump.snapshot()
+    localManualMode = advancePumpManualMode
+
+    pumpsStatus = []
+    for pumpId in range(len(localSettings.pumps)):
+        pumpUID = localSettings.pumpUIDs[pumpId]
+        pumpSlot = localState.slots.get(pumpUID)
+        if pumpSlot is None:
+            continue
+
+        if pumpUID not in localManualMode:
+            manualMode = 'auto'
+        elif localManualMode[pumpUID]:
+            manualMode = 'on'
+        else:
+            manualMode = 'off'
+
+        pumpsStatus.append({
+            'id': pumpId,
+            'uid': pumpUID,
+            'name': localSettings.pumps[pumpId].name,
+            'online': localState.health[pumpSlot] != pumpOffline,
+            'health': pumpHealthNames[localState.health[pumpSlot]],
+            'on': bool(localState.switchOn[pumpSlot]),
+            'manual': manualMode,
+            'lastSeen': (currentDatime - timedelta(seconds = checkTime - localState.lastOnline[pumpSlot])).strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+    return {'settingsVersion': localSettings.version, 'stateVersion': stateVersion, 'pumps': pumpsStatus, 'power': getPowerStatus(), 'dbQueue': getDBQueueStats()}
+
+def getMetrics():
+    """ Copy of all metrics with type and help, dictionary of metric name: {'type', 'help', 'values'}"""
+    with mutexMetrics:
+        metricsCopy = [(metricName, labels, list(metricValue) if isinstance(metricValue, list) else metricValue) for (metricName, labels), metricValue in metricsValues.items()]
+
+    allMetrics = {}
+    for metricName in metricsHelp:
+        allMetrics[metricName] = {'type': metricsHelp[metricName][0], 'help': metricsHelp[metricName][1], 'values': []}
+
+    for metricName, labels, metricValue in sorted(metricsCopy, key = lambda metric: (metric[0], metric[1])):
+        if isinstance(metricValue, list):
+            # cumulative counts, as Prometheus buckets
+            bucketsCount = []
+            cumulativeCount = 0
+            for bucketId in range(len(metricsBuckets)):
+                cumulativeCount += metricValue[bucketId]
+                bucketsCount.append([metricsBuckets[bucketId], cumulativeCount])
+            allMetrics[metricName]['values'].append({'labels': dict(labels), 'buckets': bucketsCount, 'sum': metricValue[-2], 'count': metricValue[-1]})
         else:
-            commandURL = u"http://" + pumpIP + u"/relay/0?turn=off"
-        response = None
+            allMetrics[metricName]['values'].append({'labels': dict(labels), 'value': metricValue})
+
+    # current state, read when metrics are requested
+    dbStats = getDBQueueStats()
+    allMetrics['advance_pump_db_backlog'] = {'type': 'gauge', 'help': "Events waiting for data-base writer", 'values': [{'labels': {}, 'value': dbStats['backlog']}]}
+    allMetrics['advance_pump_db_dropped_total'] = {'type': 'counter', 'help': "Events dropped with data-base queue full", 'values': [{'labels': {}, 'value': dbStats['dropped']}]}
+    allMetrics['advance_pump_db_written_total'] = {'type': 'counter', 'help': "Events written to data-base", 'values': [{'labels': {}, 'value': dbStats['written']}]}
+
+    localState = stateAdvPump.snapshot()
+    pumpsHealth = [0] * len(pumpHealthNames)
+    for pumpSlot in localState.slots.values():
+        pumpsHealth[localState.health[pumpSlot]] += 1
+    allMetrics['advance_pump_pumps'] = {'type': 'gauge', 'help': "Pumps by health", 'values': [{'labels': {'health': pumpHealthNames[health]}, 'value': pumpsHealth[health]} for health in range(len(pumpHealthNames))]}
+
+    return allMetrics
+
+def formatPrometheusLabels(labels):
+    """ Labels in Prometheus text format, with extra labels of buckets"""
+    if len(labels) == 0:
+        return u""
+
+    labelsText = []
+    for labelName in sorted(labels):
+        labelValue = str(labels[labelName]).replace(u"\\", u"\\\\").replace(u"\"", u"\\\"").replace(u"\n", u"\\n")
+        labelsText.append(labelName + u"=\"" + labelValue + u"\"")
+
+    return u"{" + u",".join(labelsText) + u"}"
+
+def formatPrometheusMetrics(allMetrics):
+    """ Metrics in Prometheus text exposition format"""
+    metricsLines = []
+    for metricName in sorted(allMetrics):
+        metric = allMetrics[metricName]
+        metricsLines.append(u"# HELP " + metricName + u" " + metric['help'])
+        metricsLines.append(u"# TYPE " + metricName + u" " + metric['type'])
+
+        for metricValue in metric['values']:
+            if 'buckets' in metricValue:
+                for bucketLimit, bucketCount in metricValue['buckets']:
+                    metricsLines.append(metricName + u"_bucket" + formatPrometheusLabels(dict(metricValue['labels'], le = repr(bucketLimit))) + u" " + str(bucketCount))
+                metricsLines.append(metricName + u"_bucket" + formatPrometheusLabels(dict(metricValue['labels'], le = u"+Inf")) + u" " + str(metricValue['count']))
+                metricsLines.append(metricName + u"_sum" + formatPrometheusLabels(metricValue['labels']) + u" " + repr(metricValue['sum']))
+                metricsLines.append(metricName + u"_count" + formatPrometheusLabels(metricValue['labels']) + u" " + str(metricValue['count']))
+            else:
+                metricsLines.append(metricName + formatPrometheusLabels(metricValue['labels']) + u" " + str(metricValue['value']))
 
-        resposeIsOk, response = requestHTTP(commandURL)
-    else:
-        pass
-        # TODO: another supported device
+    return u"\n".join(metricsLines) + u"\n"
 
-    return resposeIsOk
+# control thread profile on request, stack sampled from other thread, nothing runs when not profiling
+profileInterval = 0.005 # seconds between samples
+profileMaxSeconds = 60 # maximum time of one profile
+profileStackDepth = 16 # frames saved of each sample
+mutexProfile = Lock()
 
-def runTreadPump():
-    global settingsAdvancePump, mutexAdvPump, pumpsStateVect, lasTimeOnLine, switchPumpStatus, advancePumpManualMode, isRuning
+def profileControlThread(seconds : float):
+    """ Sample stack of control thread, return dictionary of folded stack ('function:line;function:line'): samples, None if other profile is running"""
+    if not mutexProfile.acquire(False):
+        return None
 
-    mutexAdvPump.acquire()
-    lastPupState = copy.deepcopy(pumpsStateVect)
-    lastAdvPumpManualMode = copy.deepcopy(advancePumpManualMode)
-    mutexAdvPump.release()
+    try:
+        stackSamples = {}
+        profileEnd = monotonic() + min(max(seconds, 0), profileMaxSeconds)
+        while monotonic() < profileEnd and threadMain is not None and threadMain.is_alive():
+            frame = sys._current_frames().get(threadMain.ident)
+
+            stackFrames = []
+            while frame is not None and len(stackFrames) < profileStackDepth:
+                stackFrames.append(frame.f_code.co_name + u":" + str(frame.f_lineno))
+                frame = frame.f_back
+            del frame
+
+            stackKey = u";".join(reversed(stackFrames))
+            stackSamples[stackKey] = stackSamples.get(stackKey, 0) + 1
+
+            sleep(profileInterval)
+    finally:
+        mutexProfile.release()
+
+    return stackSamples
+
+# pumps events are saved to data-base by writer thread, control thread never wait for data-base
+dbQueueSize = 512 # maximum events waiting, new events are dropped when full
+dbBatchSize = 64 # maximum events written in one batch
+dbQueueAdvPump = queue.Queue(maxsize = dbQueueSize)
+dbStatsLock = Lock()
+dbDroppedEvents = 0
+dbWrittenEvents = 0
+threadDBWriter = None
+
+dbTableElements = {"AdvancePumpDateBegin": "datetime", "AdvancePumpDateEnd": "datetime"}
+dbLogsTableElements = {"AdvancePumpLogsDate": "datetime", "AdvancePumpLogsData": "text"}
+
+def queueDBEvent(eventType : str, pumpName : str, eventData):
+    """ Add pump event to data-base queue, types: 'on', 'off' and 'log'. Return False if event is dropped"""
+    global dbDroppedEvents
 
-    lastTime = datetime.now()
+    try:
+        dbQueueAdvPump.put_nowait((eventType, pumpName.strip(), eventData))
+    except queue.Full:
+        with dbStatsLock:
+            dbDroppedEvents += 1
+        return False
+
+    return True
+
+def getDBQueueStats():
+    """ Events waiting, dropped and written by data-base writer"""
+    with dbStatsLock:
+        dbStats = {'backlog': dbQueueAdvPump.qsize(), 'dropped': dbDroppedEvents, 'written': dbWrittenEvents}
+
+    return dbStats
+
+def coalesceDBEvents(dbEvents):
+    """ Join events of same pump: turn on and off become one register, only last turn off is needed"""
+    coalescedEvents = []
+    lastTurnOn = {}
+    lastTurnOff = {}
+
+    for eventType, pumpName, eventData in dbEvents:
+        if eventType == 'on':
+            lastTurnOn[pumpName] = len(coalescedEvents)
+            lastTurnOff.pop(pumpName, None)
+            coalescedEvents.append([eventType, pumpName, [eventData, eventData]])
+        elif eventType == 'off' and pumpName in lastTurnOn:
+            # register still not saved, save it with end date
+            coalescedEvents[lastTurnOn[pumpName]][2][1] = eventData
+        elif eventType == 'off' and pumpName in lastTurnOff:
+            coalescedEvents[lastTurnOff[pumpName]][2] = eventData
+        elif eventType == 'off':
+            lastTurnOff[pumpName] = len(coalescedEvents)
+            coalescedEvents.append([eventType, pumpName, eventData])
+        else:
+            coalescedEvents.append([eventType, pumpName, eventData])
 
-    # Check if to save pumps logs in data-base
-    mutexAdvPump.acquire()
-    localSettings = copy.deepcopy(settingsAdvancePump)
-    mutexAdvPump.release()
-    if withDBLogger and localSettings['PumpDBLog']:
-        dbDefinitions = db_logger_read_definitions()
+    return coalescedEvents
+
+def writeDBBatch(dbEvents, dbDefinitions, tablesCreated):
+    """ Write batch of events to data-base, tables are created only first time"""
+    for eventType, pumpName, eventData in coalesceDBEvents(dbEvents):
+        if eventType == 'log':
+            tableName = "advance_pump_logs_" + pumpName
+            tableElements = dbLogsTableElements
+        else:
+            tableName = "advance_pump_" + pumpName
+            tableElements = dbTableElements
+
+        if tableName not in tablesCreated:
+            create_generic_table(tableName, tableElements, dbDefinitions)
+            tablesCreated.add(tableName)
+
+        if eventType == 'on' or eventType == 'log':
+            add_date_generic_table(tableName, eventData, dbDefinitions)
+        elif eventType == 'off':
+            change_last_register(tableName, 2, eventData, dbDefinitions)
+
+def runThreadDBWriter():
+    global dbWrittenEvents
+
+    dbDefinitions = None
+    tablesCreated = set()
+    isWriting = True
+
+    while isWriting:
+        dbEvents = [dbQueueAdvPump.get()]
+
+        # join events that arrive during last write
+        while len(dbEvents) < dbBatchSize:
+            try:
+                dbEvents.append(dbQueueAdvPump.get_nowait())
+            except queue.Empty:
+                break
+
+        # None is stop mark, write what is before it
+        if None in dbEvents:
+            dbEvents = dbEvents[:dbEvents.index(None)]
+            isWriting = False
+
+        # tables may be renamed by settings page, check again
+        if ('reset', u"", None) in dbEvents:
+            tablesCreated.clear()
+            dbEvents = [dbEvent for dbEvent in dbEvents if dbEvent[0] != 'reset']
+
+        if len(dbEvents) == 0:
+            continue
+
+        try:
+            if dbDefinitions is None:
+                dbDefinitions = db_logger_read_definitions()
+            writeStart = monotonic()
+            writeDBBatch(dbEvents, dbDefinitions, tablesCreated)
+            observeMetric('advance_pump_db_write_seconds', monotonic() - writeStart)
+
+            with dbStatsLock:
+                dbWrittenEvents += len(dbEvents)
+        except Exception as e:
+            countMetric('advance_pump_db_errors_total')
+            print("Advance pump data-base error", e)
+
+def stopDBWriter(timeout):
+    """ Write events in queue and stop writer"""
+    global threadDBWriter
+
+    if threadDBWriter is not None and threadDBWriter.is_alive():
+        try:
+            dbQueueAdvPump.put(None, timeout = timeout)
+        except queue.Full:
+            pass
+        threadDBWriter.join(timeout)
+    threadDBWriter = None
+
+def getDesiredState():
+    """ State that pumps must have by uid, manual mode, planned change or from valves"""
+    pumpSlots, desiredColumn = stateAdvPump.copyDesired()
+    localManualMode = advancePumpManualMode
+    localPlannedStates = plannedStatesAdvPump
+
+    desiredState = {}
+    for pumpUID, pumpSlot in pumpSlots.items():
+        desiredState[pumpUID] = localManualMode.get(pumpUID, localPlannedStates.get(pumpUID, bool(desiredColumn[pumpSlot])))
+
+    return desiredState
+
+def admitPumpPower(localSettings, pumpId : int, isRunning : bool):
+    """ Count pump power in running power, return False if budget is full and pump must wait. Call with mutexAdvPump locked"""
+    global runningPower, queuedPower
+
+    pumpUID = localSettings.pumpUIDs[pumpId]
+    if pumpUID in pumpLoad:
+        return True
+
+    pumpPower = localSettings.pumpPowers[pumpId]
+    powerBudget = float(localSettings.options['PumpPowerBudget'])
+
+    # pump already running is always counted
+    if not isRunning and powerBudget > 0 and runningPower + pumpPower > powerBudget + 1e-6:
+        if pumpUID not in waitingPumps:
+            try:
+                pumpPriority = int(localSettings.pumps[pumpId].priority)
+            except (TypeError, ValueError):
+                pumpPriority = 0
+            waitingPumps[pumpUID] = (pumpPriority, monotonic(), pumpPower)
+            queuedPower += pumpPower
+        return False
+
+    if pumpUID in waitingPumps:
+        queuedPower -= waitingPumps.pop(pumpUID)[2]
+    pumpLoad[pumpUID] = pumpPower
+    runningPower += pumpPower
+
+    return True
+
+def releasePumpPower(pumpUID : int):
+    """ Remove pump from running power and from waiting pumps. Call with mutexAdvPump locked"""
+    global runningPower, queuedPower
+
+    if pumpUID in waitingPumps:
+        queuedPower -= waitingPumps.pop(pumpUID)[2]
+    if pumpUID in pumpLoad:
+        runningPower -= pumpLoad.pop(pumpUID)
+
+def getWaitingPumps():
+    """ Pumps waiting for power, higher priority (small number) and older request first"""
+    with mutexAdvPump:
+        return sorted(waitingPumps, key = lambda pumpUID: waitingPumps[pumpUID][:2])
+
+def getPowerStatus():
+    """ Running and projected power (running and waiting pumps) to show in home page"""
+    localSettings = snapshotAdvPump
+
+    with mutexAdvPump:
+        return {'budget': float(localSettings.options['PumpPowerBudget']), 'running': round(runningPower, 3), 'projected': round(runningPower + queuedPower, 3),
+                'waiting': sorted(localSettings.uidIndex[pumpUID] for pumpUID in waitingPumps if pumpUID in localSettings.uidIndex)}
+
+def reconcilePumps(localSettings, pumpUIDs):
+    """
+    Send command to pumps where desired state is different of device state, or device state is too old.
+    Changes before minimum on/off time or start delay are not sent, return list of (due time, pump uid) of them
+    """
+    global mutexAdvPump, pendingCommands, pumpSwitchTimes, lastStartTime
+
+    pumpCommands = []
+    deferredPumps = []
+    checkTime = monotonic()
+    startStagger = float(localSettings.options['PumpStartStagger'])
+    leaseTime = getLeaseTime(localSettings)
+
+    with mutexAdvPump:
+        # device answers change store only after remove command from pendingCommands, copy is consistent with it
+        localState = stateAdvPump.snapshot()
+        localManualMode = advancePumpManualMode
+        localPlannedStates = plannedStatesAdvPump
+
+        def getSetState(pumpUID):
+            pumpSlot = localState.slots.get(pumpUID)
+            return pumpSlot is not None and localManualMode.get(pumpUID, localPlannedStates.get(pumpUID, bool(localState.desired[pumpSlot])))
+
+        # with power budget, pumps that stop free power first and pumps waiting for power get it before new requests
+        if float(localSettings.options['PumpPowerBudget']) > 0:
+            stopPumps = [pumpUID for pumpUID in pumpUIDs if not getSetState(pumpUID)]
+            stopSet = set(stopPumps)
+            queuedPumps = [pumpUID for pumpUID in sorted(waitingPumps, key = lambda pumpUID: waitingPumps[pumpUID][:2]) if pumpUID not in stopSet]
+            pumpUIDs = stopPumps + queuedPumps + [pumpUID for pumpUID in pumpUIDs if pumpUID not in stopSet and pumpUID not in waitingPumps]
+
+        for pumpUID in pumpUIDs:
+            # pump deleted or not in this settings
+            pumpId = localSettings.uidIndex.get(pumpUID)
+            pumpSlot = localState.slots.get(pumpUID)
+            if pumpId is None or pumpSlot is None:
+                continue
+
+            setState = getSetState(pumpUID)
+            pumpIP = localSettings.pumps[pumpId].ip
+
+            # same command still waiting for device answer, or lease renew of running pump. Stop is sent without wait renew, its answer is checked again
+            if pendingCommands.get(pumpUID) == (setState, pumpIP) or (setState and pendingCommands.get(pumpUID) == ('lease', pumpIP)):
+                continue
+
+            # devices without answer do not receive commands, they are checked by status request with backoff and reconciled when they answer
+            if localState.health[pumpSlot] == pumpOffline:
+                continue
+
+            isSwitchOn = bool(localState.switchOn[pumpSlot])
+            isObserved = checkTime - localState.observedTime[pumpSlot] < observedStaleTime
+
+            # device already in desired state, pump already running is always counted and stopped pump free its power
+            if isSwitchOn == setState and isObserved:
+                if setState:
+                    admitPumpPower(localSettings, pumpId, True)
+                else:
+                    releasePumpPower(pumpUID)
+                continue
+
+            if setState != isSwitchOn:
+                lastOnTime, lastOffTime = pumpSwitchTimes.get(pumpUID, (float('-inf'), float('-inf')))
+                minOnTime, minOffTime = localSettings.pumpTimes[pumpId]
+
+                # manual mode only wait start delay, avoid to start all pumps at same time
+                if setState:
+                    dueTime = lastStartTime + startStagger
+                    if pumpUID not in localManualMode:
+                        dueTime = max(dueTime, lastOffTime + minOffTime)
+                elif pumpUID not in localManualMode:
+                    dueTime = lastOnTime + minOnTime
+                else:
+                    dueTime = checkTime
+
+                if dueTime > checkTime:
+                    deferredPumps.append((dueTime, pumpUID))
+                    continue
+
+            # power is counted when start command is sent and free when stop command is sent, start only if there is power for pump
+            if not setState:
+                releasePumpPower(pumpUID)
+            elif not admitPumpPower(localSettings, pumpId, isSwitchOn and isObserved):
+                continue
+
+            if setState != isSwitchOn:
+                if setState:
+                    pumpSwitchTimes[pumpUID] = (checkTime, lastOffTime)
+                    lastStartTime = checkTime
+                else:
+                    pumpSwitchTimes[pumpUID] = (lastOnTime, checkTime)
+
+            pendingCommands[pumpUID] = (setState, pumpIP)
+            pumpCommands.append((pumpUID, localSettings.pumps[pumpId].deviceType, pumpIP, setState, localSettings.pumps[pumpId].mqttId.strip()))
+
+    for pumpUID, deviceType, pumpIP, setState, mqttId in pumpCommands:
+        future = poolCommands.submit(pupmpAction, deviceType, pumpIP, setState, leaseTime, mqttId)
+        future.add_done_callback(partial(onCommandAnswer, pumpUID, pumpIP, setState))
+
+    return deferredPumps
+
+def onCommandAnswer(pumpUID : int, pumpIP : str, setState : bool, future):
+    """ Device answer of command is the new device state, no need to read status again"""
+    global mutexAdvPump, pendingCommands, stateAdvPump
+
+    if future.cancelled() or future.exception() is not None:
+        resposeIsOk, isTurnOn = 1, False
     else:
-        dbDefinitions = {}
+        resposeIsOk, isTurnOn = future.result()
+    countMetric('advance_pump_commands_total', (('result', 'ok' if resposeIsOk == 0 else 'error'),))
+
+    isFailed = False
+    with mutexAdvPump:
+        if pendingCommands.get(pumpUID) == (setState, pumpIP):
+            del pendingCommands[pumpUID]
+
+            # pumps that publish state are requested only as fallback
+            if resposeIsOk == 0:
+                commandFailures.pop(pumpUID, None)
+                logHealthChanges(stateAdvPump.setObserved({pumpUID: (resposeIsOk, isTurnOn)}, monotonic(), mqttPollPeriod if pumpUID in getMQTTPumps() else None))
+            else:
+                # failed start do not use power, pump is counted again when retry is sent or device confirm it running
+                pumpState = stateAdvPump.read(pumpUID)
+                if setState and (pumpState is None or not pumpState.switchOn):
+                    releasePumpPower(pumpUID)
+                commandFailures[pumpUID] = commandFailures.get(pumpUID, 0) + 1
+                commandsFailed.add(pumpUID)
+                isFailed = True
+
+    if isFailed:
+        wakeControlLoop()
+    notifyStateChange()
+
+def getLeaseTime(localSettings):
+    """ Seconds of device auto-off timer of running pumps, 0 if disabled"""
+    leaseTime = int(localSettings.options['PumpLeaseTime'])
+    if leaseTime <= 0:
+        return 0
+    return max(leaseTime, leaseMinTime)
+
+def getLeaseRenewPeriod(leaseTime : int):
+    """ Seconds between lease renews, without lease timer only wait it be enabled"""
+    if leaseTime > 0:
+        return float(leaseTime) / leaseRenewFraction
+    return keepStatePeriod
+
+def renewPumpLeases(localSettings):
+    """
+    Renew auto-off timer of running pumps before expire, one task for each device with all its running relays.
+    Answer of device is relay state, running pumps do not need status requests
+    """
+    global mutexAdvPump, pendingCommands
+
+    leaseTime = getLeaseTime(localSettings)
+    if leaseTime == 0:
+        return
+
+    renewGroups = {}
+    with mutexAdvPump:
+        localState = stateAdvPump.snapshot()
+        localManualMode = advancePumpManualMode
+        localPlannedStates = plannedStatesAdvPump
+
+        for pump in localSettings.pumps:
+            driver = getPumpDriver(pump.deviceType)
+            pumpSlot = localState.slots.get(pump.uid)
+            if driver is None or not driver.supportsLease or pumpSlot is None or pump.uid in pendingCommands:
+                continue
+
+            # only pumps that must run and device confirmed on, other pumps are turned on by reconcile. Off-line devices are checked by status request
+            if not localManualMode.get(pump.uid, localPlannedStates.get(pump.uid, bool(localState.desired[pumpSlot]))) or not localState.switchOn[pumpSlot] or localState.health[pumpSlot] == pumpOffline:
+                continue
+
+            pendingCommands[pump.uid] = ('lease', pump.ip)
+            renewGroups.setdefault((pump.deviceType, driver.group_key(pump.ip)), []).append(pump)
+
+    for (deviceType, groupKey), groupPumps in renewGroups.items():
+        pumpIPs = [pump.ip for pump in groupPumps]
+        future = poolCommands.submit(getPumpDriver(deviceType).renew_leases, pumpIPs, leaseTime)
+        future.add_done_callback(partial(onLeaseAnswer, [pump.uid for pump in groupPumps], pumpIPs))
+
+def onLeaseAnswer(pumpUIDs, pumpIPs, future):
+    """ Save relay state of renew answers, control thread check pumps again, desired state could change while waiting"""
+    global mutexAdvPump, pendingCommands, stateAdvPump
+
+    if future.cancelled() or future.exception() is not None:
+        pumpsStatus = {}
+    else:
+        pumpsStatus = future.result()
+
+    observedStates = {}
+    with mutexAdvPump:
+        for pumpUID, pumpIP in zip(pumpUIDs, pumpIPs):
+            if pendingCommands.get(pumpUID) == ('lease', pumpIP):
+                del pendingCommands[pumpUID]
+                observedStates[pumpUID] = pumpsStatus.get(pumpIP, (1, False))
+                leaseAnswered.add(pumpUID)
+                countMetric('advance_pump_lease_renewals_total', (('result', 'ok' if observedStates[pumpUID][0] == 0 else 'error'),))
+            elif pumpUID not in pendingCommands and pumpsStatus.get(pumpIP, (1, False))[0] == 0:
+                # stop command sent during renew is already answered, renew could turn on pump again after it
+                observedStates[pumpUID] = pumpsStatus[pumpIP]
+                leaseAnswered.add(pumpUID)
+                countMetric('advance_pump_lease_renewals_total', (('result', 'late'),))
+        healthChanges = stateAdvPump.setObserved(observedStates, monotonic())
+
+    logHealthChanges(healthChanges)
+    wakeControlLoop()
+    notifyStateChange()
+
+def planRunSchedule(localSettings, leadTime : float):
+    """
+    Pumps changes of stations that start or stop in next seconds, from SIP run schedule and valves rules of pumps.
+    Return list of (change time, end time, valves time, pump uid, state), times are monotonic and change is leadTime before valves
+    """
+    checkTime = monotonic()
+    sipTime = gv.now
+    planHorizon = leadTime + lookaheadPeriod
+
+    # valves changes by SIP time, station start and stop
+    valvesEvents = {}
+    for sid in range(min(len(gv.rs), len(gv.srvals))):
+        startTime, stopTime = gv.rs[sid][0], gv.rs[sid][1]
+        if sipTime < startTime <= sipTime + planHorizon:
+            valvesEvents.setdefault(startTime, []).append((sid, True))
+        if startTime > 0 and sipTime < stopTime <= sipTime + planHorizon:
+            valvesEvents.setdefault(stopTime, []).append((sid, False))
+
+    valvesMask = 0
+    for sid in range(len(gv.srvals)):
+        if gv.srvals[sid]:
+            valvesMask |= 1 << sid
+    existValvesMask = (1 << len(gv.srvals)) - 1
+
+    # valves state after each change, only pumps of valves that change are checked
+    pumpsNeed = [pumpNeedByValves(pumpMasks, valvesMask, existValvesMask) for pumpMasks in localSettings.pumpMasks]
+    plannedChanges = []
+    for eventTime in sorted(valvesEvents):
+        changedPumps = set()
+        for sid, isOn in valvesEvents[eventTime]:
+            if isOn:
+                valvesMask |= 1 << sid
+            else:
+                valvesMask &= ~(1 << sid)
+            changedPumps.update(localSettings.valvesIndex.get(sid, ()))
+
+        valvesTime = checkTime + (eventTime - sipTime)
+        for pumpId in sorted(changedPumps):
+            pumpNeed = pumpNeedByValves(localSettings.pumpMasks[pumpId], valvesMask, existValvesMask)
+            if pumpNeed != pumpsNeed[pumpId]:
+                pumpsNeed[pumpId] = pumpNeed
+                plannedChanges.append((valvesTime - leadTime, valvesTime + plannedGraceTime, valvesTime, localSettings.pumpUIDs[pumpId], pumpNeed))
+
+    return plannedChanges
+
+def getPlannedStates(plannedChanges, checkTime : float):
+    """ State of pumps with planned change in progress, if one pump have more changes last one started is used"""
+    plannedStates = {}
+    for changeTime, endTime, valvesTime, pumpUID, pumpState in sorted(plannedChanges):
+        if changeTime <= checkTime < endTime:
+            plannedStates[pumpUID] = pumpState
+    return plannedStates
+
+def wakeControlLoop():
+    """ Wake up control thread, state of pumps or settings changed"""
+    wakeAdvPump.set()
+
+def runTreadPump():
+    global mutexAdvPump, advancePumpManualMode, isRuning, plannedStatesAdvPump
+
+    warmUpAdvancePump()
+
+    # all pumps are new in first iteration, they receive state of valves read in warm-up
+    lastDesiredState = {}
+
+    # status sweep running in poll pool
+    sweepFutures = None
+    sweepStart = monotonic()
+
+    # periodic tasks, heap ordered by due time
+    timersPump = []
+    heapq.heappush(timersPump, (monotonic(), 'keepState'))
+    heapq.heappush(timersPump, (monotonic(), 'onlineCheck'))
+    heapq.heappush(timersPump, (monotonic(), 'lookahead'))
+    heapq.heappush(timersPump, (monotonic(), 'history'))
+    leaseScheduled = None # lease time used in leaseRenew timer
+
+    # pumps changes from run schedule, planned states are checked again in each change and end time after planCheckTime
+    plannedChanges = []
+    planCheckTime = float('-inf')
+
+    # pumps changes waiting minimum on/off time or start delay, heap ordered by due time
+    transitionsPump = []
+    transitionsDue = {}
+
+    def deferTransitions(deferredPumps):
+        for dueTime, pumpUID in deferredPumps:
+            if transitionsDue.get(pumpUID) != dueTime:
+                transitionsDue[pumpUID] = dueTime
+                heapq.heappush(transitionsPump, (dueTime, pumpUID))
 
     while isRuning:
-        sleep(1)
+        # sleep until next timer, next pump change or until a zone, manual mode or settings change
+        nextDue = timersPump[0][0]
+        if len(transitionsPump) > 0:
+            nextDue = min(nextDue, transitionsPump[0][0])
+        for changeTime, endTime, valvesTime, pumpUID, pumpState in plannedChanges:
+            for planTime in (changeTime, endTime):
+                if planTime > planCheckTime:
+                    nextDue = min(nextDue, planTime)
+        wakeAdvPump.wait(max(nextDue - monotonic(), 0))
+        stateChanged = wakeAdvPump.is_set()
+        wakeAdvPump.clear()
+        iterationStart = monotonic()
+
+        if not isRuning:
+            break
+
+        # planned changes that start or end now change desired state of pumps
+        if len(plannedChanges) > 0 or len(plannedStatesAdvPump) > 0:
+            planCheckTime = monotonic()
+
+            # changes confirmed by zone change signal are removed, next valves changes are used
+            pumpSlots, desiredColumn = stateAdvPump.copyDesired()
+            plannedChanges = [plannedChange for plannedChange in plannedChanges if plannedChange[1] > planCheckTime and
+                              not (plannedChange[2] <= planCheckTime and plannedChange[3] in pumpSlots and bool(desiredColumn[pumpSlots[plannedChange[3]]]) == plannedChange[4])]
+
+            plannedStates = getPlannedStates(plannedChanges, planCheckTime)
+            if plannedStates != plannedStatesAdvPump:
+                plannedStatesAdvPump = MappingProxyType(plannedStates)
+                stateChanged = True
+
         listPups2TurnOn = []
         listPups2TurnOff = []
+        listPumps2Boot = []
 
-        listPumps2TurOnBoot = []
-        listPumps2TurOffBoot = []
-
-        listPups2KeepOn = []
-        listPups2KeepOff = []
+        localSettings = snapshotAdvPump
 
-        mutexAdvPump.acquire()
-        localSettings = copy.deepcopy(settingsAdvancePump)
+        if stateChanged:
+            desiredState = getDesiredState()
 
-        # for new pupms fix the state
-        if len(pumpsStateVect) > len(lastPupState):
-            for newPump in range(len(lastPupState), len(pumpsStateVect)):
-                if pumpsStateVect[newPump]:
-                    listPumps2TurOnBoot.append(newPump)
-                else:
-                    listPumps2TurOffBoot.append(newPump)
-
-        for currentPumpId in range(min(len(pumpsStateVect), len(lastPupState))):
-            if pumpsStateVect[currentPumpId]:
-                if pumpsStateVect[currentPumpId] != lastPupState[currentPumpId]:
-                    listPups2TurnOn.append(currentPumpId)
-                else:
-                    listPups2KeepOn.append(currentPumpId)
-            else:
-                if pumpsStateVect[currentPumpId] != lastPupState[currentPumpId]:
-                    listPups2TurnOff.append(currentPumpId)
-                else:
-                    listPups2KeepOff.append(currentPumpId)
-
-        # check pupms in manual mode
-        for pumpIdManual in advancePumpManualMode:
-            # pump force to turn off
-            if not advancePumpManualMode[pumpIdManual] and pumpIdManual in listPups2TurnOn:
-                listPups2TurnOn.remove(pumpIdManual)
-            if not advancePumpManualMode[pumpIdManual] and pumpIdManual not in listPups2TurnOff and (pumpIdManual not in lastAdvPumpManualMode or lastAdvPumpManualMode[pumpIdManual]):
-                listPups2TurnOff.append(pumpIdManual)
-
-            # pump force to turn on
-            if advancePumpManualMode[pumpIdManual] and pumpIdManual not in listPups2TurnOn and (pumpIdManual not in lastAdvPumpManualMode or not lastAdvPumpManualMode[pumpIdManual]):
-                listPups2TurnOn.append(pumpIdManual)
-            if advancePumpManualMode[pumpIdManual] and pumpIdManual in listPups2TurnOff:
-                listPups2TurnOff.remove(pumpIdManual)
-
-            # remove keep state if in manual mode
-            if pumpIdManual in listPups2KeepOn:
-                listPups2KeepOn.remove(pumpIdManual)
-            if pumpIdManual in listPups2KeepOff:
-                listPups2KeepOff.remove(pumpIdManual)
-
-        # save last pupms stats, to check changes
-        lastPupState = copy.deepcopy(pumpsStateVect)
-        mutexAdvPump.release()
-
-        # send signal to station that change to ON
+            for currentPumpUID in desiredState:
+                if currentPumpUID not in lastDesiredState:
+                    # for new pupms fix the state
+                    listPumps2Boot.append(currentPumpUID)
+                elif desiredState[currentPumpUID] != lastDesiredState[currentPumpUID]:
+                    if desiredState[currentPumpUID]:
+                        listPups2TurnOn.append(currentPumpUID)
+                    else:
+                        listPups2TurnOff.append(currentPumpUID)
+
+            # save last pupms stats, to check changes
+            lastDesiredState = desiredState
+
+            # broker connection lost or pumps added, pumps that need status are checked now
+            if sweepFutures is None:
+                timersPump = [timer for timer in timersPump if timer[1] != 'onlineCheck']
+                timersPump.append((max(stateAdvPump.nextPollTime(), monotonic()), 'onlineCheck'))
+                heapq.heapify(timersPump)
+
+            # program start could schedule next stations, plan them now
+            if float(localSettings.options['PumpLookahead']) > 0:
+                timersPump = [timer for timer in timersPump if timer[1] != 'lookahead']
+                timersPump.append((monotonic(), 'lookahead'))
+                heapq.heapify(timersPump)
+
+        # send signal to pumps that change state
+        deferTransitions(reconcilePumps(localSettings, listPups2TurnOn + listPups2TurnOff + listPumps2Boot))
+
+        # pumps with lease renewed, send command if desired state changed during renew or device did not answer
+        if len(leaseAnswered) > 0:
+            with mutexAdvPump:
+                renewedPumps = list(leaseAnswered)
+                leaseAnswered.clear()
+            deferTransitions(reconcilePumps(localSettings, renewedPumps))
+
+        # pumps with failed command are checked again after backoff, device could be busy or network lost packet
+        if len(commandsFailed) > 0:
+            with mutexAdvPump:
+                retryPumps = [(monotonic() + min(commandRetryBase * 2 ** (commandFailures.get(pumpUID, 1) - 1), commandRetryMax), pumpUID) for pumpUID in commandsFailed]
+                commandsFailed.clear()
+            deferTransitions(retryPumps)
+
+        # pumps that answer again after off-line, commands were not sent while off-line
+        recoveredPumps = stateAdvPump.claimRecovered()
+        if len(recoveredPumps) > 0:
+            deferTransitions(reconcilePumps(localSettings, recoveredPumps))
+
+        # pumps waiting for power, start them if other pumps stop
+        if len(waitingPumps) > 0:
+            deferTransitions(reconcilePumps(localSettings, getWaitingPumps()))
+
+        # pumps that can change now
+        duePumps = []
+        while len(transitionsPump) > 0 and transitionsPump[0][0] <= monotonic():
+            dueTime, pumpUID = heapq.heappop(transitionsPump)
+            if transitionsDue.get(pumpUID) == dueTime:
+                del transitionsDue[pumpUID]
+                duePumps.append(pumpUID)
+        if len(duePumps) > 0:
+            deferTransitions(reconcilePumps(localSettings, duePumps))
+
+        # save to DB turn on register
         for pupmpIdOn in listPups2TurnOn:
-            if pupmpIdOn < len(localSettings):
-                #pupmpAction(localSettings['PumpDeviceType'][pupmpIdOn], localSettings['PumpIP'][pupmpIdOn], True)
-                # save to DB turn on register
-                listElements = {"AdvancePumpDateBegin": "datetime", "AdvancePumpDateEnd": "datetime"}
-                create_generic_table("advance_pump_" + localSettings['PumpName'][pupmpIdOn].strip(), listElements, dbDefinitions)
-                turnOnDateTime = datetime.now()
-                listData = [turnOnDateTime.strftime("%Y-%m-%d %H:%M:%S"), turnOnDateTime.strftime("%Y-%m-%d %H:%M:%S")]
-                add_date_generic_table("advance_pump_" + localSettings['PumpName'][pupmpIdOn].strip(), listData, dbDefinitions)
-
-        # send signal to station that change to OFF
-        for pupmpIdOff in listPups2TurnOff:
-            if pupmpIdOff < len(localSettings):
-                #pupmpAction(localSettings['PumpDeviceType'][pupmpIdOff], localSettings['PumpIP'][pupmpIdOff], False)
-                # save to DB turn off register
-                listElements = {"AdvancePumpDateBegin": "datetime", "AdvancePumpDateEnd": "datetime"}
-                create_generic_table("advance_pump_" + localSettings['PumpName'][pupmpIdOff].strip(), listElements, dbDefinitions)
-                turnOffDateTime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                change_last_register("advance_pump_" + localSettings['PumpName'][pupmpIdOff].strip(), 2, turnOffDateTime, dbDefinitions)
-
-        # send signal to set initial state on
-        for pumpIdOnFirst in listPumps2TurOnBoot:
-            #pupmpAction(localSettings['PumpDeviceType'][pumpIdOnFirst], localSettings['PumpIP'][pumpIdOnFirst], True)
-            pass
+            if pupmpIdOn in localSettings.uidIndex and withDBLogger and localSettings.options['PumpDBLog']:
+                queueDBEvent('on', localSettings.pumps[localSettings.uidIndex[pupmpIdOn]].name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
-        # send signal to set initial state off
-        for pumpIdOffFirst in listPumps2TurOffBoot:
-            #pupmpAction(localSettings['PumpDeviceType'][pumpIdOffFirst], localSettings['PumpIP'][pumpIdOffFirst], True)
+        # save to DB turn off register
+        for pupmpIdOff in listPups2TurnOff:
+            if pupmpIdOff in localSettings.uidIndex and withDBLogger and localSettings.options['PumpDBLog']:
+                queueDBEvent('off', localSettings.pumps[localSettings.uidIndex[pupmpIdOff]].name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+        # lease enabled or changed in settings, renew with new period before leases sent with it expire
+        leaseTime = getLeaseTime(localSettings)
+        if leaseTime != leaseScheduled:
+            timersPump = [timer for timer in timersPump if timer[1] != 'leaseRenew']
+            timersPump.append((monotonic() + getLeaseRenewPeriod(leaseTime), 'leaseRenew'))
+            heapq.heapify(timersPump)
+            leaseScheduled = leaseTime
+
+        # run timers that are due
+        while len(timersPump) > 0 and timersPump[0][0] <= monotonic():
+            timerDue, timerName = heapq.heappop(timersPump)
+
+            if timerName == 'keepState':
+                # pumps that keep state receive command only if device state is different or too old, manual mode pumps do not keep state
+                localManualMode = advancePumpManualMode
+
+                listPups2Keep = [pump.uid for pump in localSettings.pumps if pump.keepState and pump.uid not in localManualMode]
+                deferTransitions(reconcilePumps(localSettings, listPups2Keep))
+
+                heapq.heappush(timersPump, (monotonic() + keepStatePeriod, 'keepState'))
+            elif timerName == 'lookahead':
+                # changes after valves time wait zone change signal and are kept, other changes are planned again
+                leadTime = float(localSettings.options['PumpLookahead'])
+                keptChanges = [plannedChange for plannedChange in plannedChanges if plannedChange[2] <= monotonic()]
+                newChanges = planRunSchedule(localSettings, leadTime) if leadTime > 0 else []
+
+                # device status is requested before command, connection is open and device state is known
+                knownChanges = set((plannedChange[3], plannedChange[4]) for plannedChange in plannedChanges)
+                for changeTime, endTime, valvesTime, pumpUID, pumpState in newChanges:
+                    if (pumpUID, pumpState) not in knownChanges:
+                        stateAdvPump.pollBefore(pumpUID, changeTime - plannedWarmTime)
+                        heapq.heappush(timersPump, (max(changeTime - plannedWarmTime, monotonic()), 'onlineCheck'))
+
+                plannedChanges = keptChanges + newChanges
+                planCheckTime = float('-inf')
+
+                heapq.heappush(timersPump, (monotonic() + lookaheadPeriod, 'lookahead'))
+            elif timerName == 'history':
+                historyAdvPump.sample(localSettings, stateAdvPump.snapshot(), monotonic())
+                heapq.heappush(timersPump, (monotonic() + historySamplePeriod, 'history'))
+            elif timerName == 'leaseRenew':
+                renewPumpLeases(localSettings)
+                heapq.heappush(timersPump, (monotonic() + getLeaseRenewPeriod(leaseTime), 'leaseRenew'))
+            elif timerName == 'onlineCheck':
+                # check pumps that need status now, without wait for devices answer. Off-line pumps wait their backoff
+                if sweepFutures is None:
+                    sweepFutures = startPumpsSweep(localSettings, stateAdvPump.claimPolls(monotonic()))
+                    sweepStart = monotonic()
+                    heapq.heappush(timersPump, (monotonic() + getSweepDeadline(), 'sweepDeadline'))
+                else:
+                    heapq.heappush(timersPump, (monotonic() + pollMinPeriod, 'onlineCheck'))
+
+        # save devices answers when sweep is over, next check when first pump need status
+        if sweepFutures is not None and sweepIsFinished(sweepFutures, sweepStart):
+            applyPumpsSweep(sweepFutures)
+            sweepFutures = None
+            observeMetric('advance_pump_sweep_seconds', monotonic() - sweepStart)
+
+            timersPump = [timer for timer in timersPump if timer[1] != 'sweepDeadline' and timer[1] != 'onlineCheck']
+            timersPump.append((max(stateAdvPump.nextPollTime(), monotonic() + pollMinPeriod), 'onlineCheck'))
+            heapq.heapify(timersPump)
+
+        observeMetric('advance_pump_loop_seconds', monotonic() - iterationStart)
+
+# settings file is written by writer thread, changes close in time are saved in one write
+settingsFile = u"./data/advance_pump.json"
+settingsSchemaVersion = 2 # version 1 is file without PumpSchemaVersion
+settingsWriteDelay = 2.0 # seconds to wait for more changes before write
+settingsWriteCondition = Condition()
+settingsPendingWrite = None # snapshot waiting to be written
+settingsWriterRunning = True
+threadSettingsWriter = None
+
+def migrateSettings(settingsDict):
+    """ Check settings read from file and convert older versions, return settings and if file must be written again"""
+    if not isinstance(settingsDict, dict):
+        raise ValueError("settings file is not a JSON object")
+
+    schemaVersion = settingsDict.get('PumpSchemaVersion', 1)
+    if not isinstance(schemaVersion, int) or schemaVersion > settingsSchemaVersion:
+        raise ValueError("unknown settings version " + str(schemaVersion))
+
+    # per pump values must be lists, options must have type of default value
+    for settingKey in defaultSettingsAdvancePump:
+        defaultValue = defaultSettingsAdvancePump[settingKey]
+        if settingKey not in settingsDict:
+            continue
+        elif isinstance(defaultValue, list):
+            if not isinstance(settingsDict[settingKey], list):
+                settingsDict[settingKey] = []
+        elif isinstance(defaultValue, bool):
+            settingsDict[settingKey] = bool(settingsDict[settingKey])
+        else:
+            try:
+                settingsDict[settingKey] = type(defaultValue)(settingsDict[settingKey])
+            except (TypeError, ValueError):
+                settingsDict[settingKey] = defaultValue
+
+    if schemaVersion < 2:
+        # delete in version 1 did not remove all per pump values, values after pump names are from deleted pumps
+        pumpNumber = len(settingsDict.get('PumpName', []))
+        for fileKey, recordField, defaultValue in pumpRecordFields:
+            if fileKey in settingsDict:
+                settingsDict[fileKey] = settingsDict[fileKey][:pumpNumber]
+
+        # valves are station numbers
+        for fileKey in ['PumpNeedValves', 'PumpNeedValvesOn', 'PumpNeedValvesOff']:
+            for pumpId in range(len(settingsDict.get(fileKey, []))):
+                pumpValves = settingsDict[fileKey][pumpId] if isinstance(settingsDict[fileKey][pumpId], list) else []
+                settingsDict[fileKey][pumpId] = [int(sid) for sid in pumpValves if isinstance(sid, int) or (isinstance(sid, str) and sid.isdigit())]
+
+    settingsDict['PumpSchemaVersion'] = settingsSchemaVersion
+
+    return settingsDict, schemaVersion != settingsSchemaVersion
+
+def readSettingsFile():
+    """ Read settings file, None if file does not exist. Damaged file is kept with .bad extension and default settings are used"""
+    try:
+        with open(settingsFile, u"r") as f:  # Read settings from json file if it exists
+            return migrateSettings(json.load(f))
+    except IOError:  # If file does not exist return empty value
+        return None, True
+    except ValueError as e:
+        print("Advance pump settings file error", e)
+        try:
+            os.replace(settingsFile, settingsFile + u".bad")
+        except OSError:
             pass
+        return None, True
 
-        # send signal to set initial state off
+def writeSettingsFile(localSettings):
+    """ Write settings to temporary file and rename it, file in disk is always complete"""
+    settingsDict = localSettings.to_dict()
+    settingsDict['PumpSchemaVersion'] = settingsSchemaVersion
 
-        # every 30 seconds force state if needed and check if valves are only
-        nowTime = datetime.now()
-        diffTime = nowTime - lastTime
-        secondsInt = int(diffTime.seconds)
-        if secondsInt > 30 or len(listPups2TurnOn) > 0 or len(listPups2TurnOff) > 0:
-            lastTime = nowTime
+    tmpFile = settingsFile + u".tmp"
+    with open(tmpFile, u"w") as f:  # write the settings to file
+        json.dump(settingsDict, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpFile, settingsFile)
 
-            # send signal to all pumps to keep on
-            for currPumpKeepOnId in listPups2KeepOn:
-                if localSettings['PumpKeepState'][currPumpKeepOnId]:
-                    #pupmpAction(localSettings['PumpDeviceType'][currPumpKeepOnId], localSettings['PumpIP'][currPumpKeepOnId], True)
-                    pass
+    # rename is saved only with directory
+    try:
+        dirFile = os.open(os.path.dirname(os.path.abspath(settingsFile)), os.O_RDONLY)
+        try:
+            os.fsync(dirFile)
+        finally:
+            os.close(dirFile)
+    except OSError:
+        pass
 
-            # send signal to all pumps to keep off
-            for currPumpKeepOffId in listPups2KeepOff:
-                if localSettings['PumpKeepState'][currPumpKeepOffId]:
-                    #pupmpAction(localSettings['PumpDeviceType'][currPumpKeepOffId], localSettings['PumpIP'][currPumpKeepOffId], False)
-                    pass
+def scheduleSettingsWrite(localSettings):
+    """ Save settings in writer thread, only last settings of changes during write delay are written"""
+    global settingsPendingWrite
+
+    with settingsWriteCondition:
+        settingsPendingWrite = localSettings
+        settingsWriteCondition.notify()
+
+def runThreadSettingsWriter():
+    global settingsPendingWrite
+
+    lastWrittenVersion = -1
+
+    while True:
+        with settingsWriteCondition:
+            settingsWriteCondition.wait_for(lambda: settingsPendingWrite is not None or not settingsWriterRunning)
+
+            # wait more changes, stop write immediately
+            writeDue = monotonic() + settingsWriteDelay
+            settingsWriteCondition.wait_for(lambda: not settingsWriterRunning, max(writeDue - monotonic(), 0))
+
+            localSettings = settingsPendingWrite
+            settingsPendingWrite = None
+            isWriting = settingsWriterRunning
+
+        if localSettings is not None and localSettings.version > lastWrittenVersion:
+            try:
+                writeSettingsFile(localSettings)
+                lastWrittenVersion = localSettings.version
+            except (IOError, OSError) as e:
+                print("Advance pump settings write error", e)
+
+        if not isWriting:
+            break
+
+def stopSettingsWriter(timeout):
+    """ Write settings waiting and stop writer"""
+    global settingsWriterRunning, threadSettingsWriter
+
+    with settingsWriteCondition:
+        settingsWriterRunning = False
+        settingsWriteCondition.notify()
+
+    if threadSettingsWriter is not None and threadSettingsWriter.is_alive():
+        threadSettingsWriter.join(timeout)
+    threadSettingsWriter = None
+
+# JSON configuration API, valves of pumps are list of stations or bit mask
+configValveFields = ('needValves', 'needValvesOn', 'needValvesOff')
+configOptionKeys = [settingKey for settingKey in defaultSettingsAdvancePump if not isinstance(defaultSettingsAdvancePump[settingKey], list) and settingKey != 'PumpNextUID']
+
+# settings form valves checkbox, valvesNeedPump<pump id><Valve|ON|Off><station>
+formValvesPattern = re.compile(r"^valvesNeedPump(\d+)(Valve|ON|Off)(\d+)$")
+formValvesFields = {'Valve': 'PumpNeedValves', 'ON': 'PumpNeedValvesOn', 'Off': 'PumpNeedValvesOff'}
+
+def parseFormValves(qdict, pumpsNumber : int, valvesNumber : int):
+    """ Valves checked in settings form, one pass in submitted keys. Return dictionary of file key to list of valves of each pump"""
+    formValves = dict((fileKey, [[] for _ in range(pumpsNumber)]) for fileKey in formValvesFields.values())
+
+    for formKey in qdict:
+        valvesMatch = formValvesPattern.match(formKey)
+        if valvesMatch is None:
+            continue
+        pumpId, sid = int(valvesMatch.group(1)), int(valvesMatch.group(3))
+        if pumpId < pumpsNumber and sid < valvesNumber:
+            formValves[formValvesFields[valvesMatch.group(2)]][pumpId].append(sid)
+
+    for fileKey in formValves:
+        for valvesList in formValves[fileKey]:
+            valvesList.sort()
+
+    return formValves
+
+def parseConfigValves(fieldValue, valvesNumber : int):
+    """ Valves of JSON pump, list of stations or bit mask. Return tuple of stations, None if invalid"""
+    if isinstance(fieldValue, bool):
+        return None
+
+    if isinstance(fieldValue, int):
+        if fieldValue < 0 or fieldValue >> valvesNumber:
+            return None
+        return tuple(sid for sid in range(valvesNumber) if fieldValue >> sid & 1)
+
+    if isinstance(fieldValue, list):
+        if not all(isinstance(sid, int) and not isinstance(sid, bool) and 0 <= sid < valvesNumber for sid in fieldValue):
+            return None
+        return tuple(sorted(set(fieldValue)))
+
+    return None
+
+def parseConfigPump(pumpConfig, valvesNumber : int):
+    """ Check one pump of JSON configuration, return dictionary of record fields to change and error (None if valid)"""
+    if not isinstance(pumpConfig, dict):
+        return None, u"pump must be an object"
+
+    pumpChanges = {}
+    for fieldName, fieldValue in pumpConfig.items():
+        if fieldName == 'uid':
+            continue
+        elif fieldName in configValveFields:
+            fieldValue = parseConfigValves(fieldValue, valvesNumber)
+            if fieldValue is None:
+                return None, fieldName + u" must be list of stations or bit mask, stations under " + str(valvesNumber)
+        elif fieldName == 'name':
+            if not isinstance(fieldValue, str) or fieldValue.strip() == u"":
+                return None, u"name must be a not empty string"
+        elif fieldName == 'ip' or fieldName == 'mqttId':
+            if not isinstance(fieldValue, str):
+                return None, fieldName + u" must be a string"
+        elif fieldName == 'deviceType':
+            if not isinstance(fieldValue, str) or (fieldValue != u"" and getPumpDriver(fieldValue) is None):
+                return None, u"unknown device type " + str(fieldValue)
+        elif fieldName == 'keepState':
+            if not isinstance(fieldValue, bool):
+                return None, u"keepState must be true or false"
+        elif fieldName == 'power':
+            if fieldValue != u"" and (isinstance(fieldValue, bool) or not isinstance(fieldValue, (int, float))):
+                return None, u"power must be a number or empty"
+        elif fieldName == 'minWorkingTime' or fieldName == 'minOffTime':
+            if isinstance(fieldValue, bool) or not isinstance(fieldValue, (str, int, float)):
+                return None, fieldName + u" must be 'HH:MM' or seconds"
+        elif fieldName == 'priority':
+            if isinstance(fieldValue, bool) or not isinstance(fieldValue, int):
+                return None, u"priority must be an integer"
+        else:
+            return None, u"unknown field " + str(fieldName)
+
+        pumpChanges[fieldName] = fieldValue
+
+    return pumpChanges, None
+
+def parseConfigOptions(optionsConfig):
+    """ Check options of JSON configuration, return dictionary of options to change and error (None if valid)"""
+    if not isinstance(optionsConfig, dict):
+        return None, u"options must be an object"
+
+    optionsChanges = {}
+    for optionKey, optionValue in optionsConfig.items():
+        if optionKey not in configOptionKeys:
+            return None, u"unknown option " + str(optionKey)
+
+        defaultValue = defaultSettingsAdvancePump[optionKey]
+        if isinstance(defaultValue, bool):
+            if not isinstance(optionValue, bool):
+                return None, optionKey + u" must be true or false"
+        elif isinstance(defaultValue, str):
+            if not isinstance(optionValue, str):
+                return None, optionKey + u" must be a string"
+            optionValue = optionValue.strip()
+        elif isinstance(optionValue, bool) or not isinstance(optionValue, (int, float)) or optionValue < 0:
+            return None, optionKey + u" must be a positive number"
+        else:
+            optionValue = type(defaultValue)(optionValue)
 
-            # check if all pupms are on-line and states
-            mutexAdvPump.acquire()
-            localOnlineState = copy.deepcopy(lasTimeOnLine)
-            localValveState = copy.deepcopy(switchPumpStatus)
-            mutexAdvPump.release()
+        optionsChanges[optionKey] = optionValue
 
-            for pumpsCheck in range(len(localSettings['PumpName'])):
-                resposeIsOk, isTurnOn = pumpIsOnLine(localSettings['PumpDeviceType'][pumpsCheck], localSettings['PumpIP'][pumpsCheck])
-                if resposeIsOk == 0:
-                    localOnlineState[pumpsCheck] = datetime.now()
+    if optionsChanges.get('PumpHTTPPoolSize', 1) < 1:
+        return None, u"PumpHTTPPoolSize must be at least 1"
 
-                    localValveState[pumpsCheck] = isTurnOn
-                else:
-                    localValveState[pumpsCheck] = False
+    return optionsChanges, None
 
-                    # TODO: if became off-line save to logs in DB
-                    if True:
-                        pass
+def applyConfigUpdate(configUpdate):
+    """
+    Check and apply JSON configuration {"options": {...}, "pumps": [{...}]}. Pumps with uid change only given fields, pumps without uid are added.
+    All is checked before any change, return new snapshot (None if invalid), uid of each pump and list of errors
+    """
+    global mutexAdvPump, stateAdvPump
 
-            mutexAdvPump.acquire()
-            lasTimeOnLine = copy.deepcopy(localOnlineState)
-            switchPumpStatus = copy.deepcopy(localValveState)
-            lastAdvPumpManualMode = copy.deepcopy(advancePumpManualMode)
-            mutexAdvPump.release()
+    if not isinstance(configUpdate, dict):
+        return None, [], [u"configuration must be an object"]
 
-# Read in the commands for this plugin from it's JSON file
-def load_advance_pump():
-    global settingsAdvancePump, mutexAdvPump, pumpsStateVect, lasTimeOnLine, switchPumpStatus, threadMain
+    configErrors = []
+    valvesNumber = gv.sd['nbrd'] * 8
 
-    mutexAdvPump.acquire()
+    optionsChanges, optionsError = parseConfigOptions(configUpdate.get('options', {}))
+    if optionsError is not None:
+        configErrors.append(optionsError)
 
-    try:
-        with open(u"./data/advance_pump.json", u"r") as f:  # Read settings from json file if it exists
-            settingsAdvancePump = json.load(f)
-    except IOError:  # If file does not exist return empty value
-        # write default values to files
-        with open(u"./data/advance_pump.json", u"w") as f:  # Edit: change name of json file
-                json.dump(settingsAdvancePump, f)  # save to file
+    pumpsConfig = configUpdate.get('pumps', [])
+    if not isinstance(pumpsConfig, list):
+        pumpsConfig = []
+        configErrors.append(u"pumps must be a list")
 
-    pumpsStateVect = [False] * len(settingsAdvancePump['PumpName'])
-    lasTimeOnLine = [datetime.now()] * len(settingsAdvancePump['PumpName'])
-    switchPumpStatus = [False] * len(settingsAdvancePump['PumpName'])
+    pumpsChanges = []
+    for pumpIdx in range(len(pumpsConfig)):
+        pumpChanges, pumpError = parseConfigPump(pumpsConfig[pumpIdx], valvesNumber)
+        if pumpError is not None:
+            configErrors.append(u"pump " + str(pumpIdx) + u": " + pumpError)
+        else:
+            pumpsChanges.append((pumpsConfig[pumpIdx].get('uid'), pumpChanges))
+
+    pumpRenames = []
+    with mutexAdvPump:
+        localSettings = snapshotAdvPump
+        pumpRecords = list(localSettings.pumps)
+        pumpUIDs = []
+
+        for pumpIdx in range(len(pumpsChanges)):
+            pumpUID, pumpChanges = pumpsChanges[pumpIdx]
+
+            if pumpUID is None:
+                # new pump, uid is given when snapshot is built
+                if 'name' not in pumpChanges:
+                    configErrors.append(u"pump " + str(pumpIdx) + u": new pump need name")
+                    continue
+                newRecord = PumpRecord(*[recordField[2] for recordField in pumpRecordFields])
+                pumpRecords.append(newRecord._replace(**pumpChanges))
+                pumpUIDs.append(None)
+                continue
+
+            pumpId = localSettings.uidIndex.get(pumpUID) if isinstance(pumpUID, int) and not isinstance(pumpUID, bool) else None
+            if pumpId is None:
+                configErrors.append(u"pump " + str(pumpIdx) + u": unknown uid " + str(pumpUID))
+                continue
+
+            if 'name' in pumpChanges and pumpChanges['name'].strip() != pumpRecords[pumpId].name.strip():
+                pumpRenames.append((pumpRecords[pumpId].name.strip(), pumpChanges['name'].strip()))
+            pumpRecords[pumpId] = pumpRecords[pumpId]._replace(**pumpChanges)
+            pumpUIDs.append(pumpUID)
+
+        if len(configErrors) > 0:
+            return None, [], configErrors
+
+        settingsOptions = dict(localSettings.options)
+        settingsOptions.update(optionsChanges)
+
+        localSettings = publishSettings(settingsOptions, pumpRecords)
+        stateAdvPump.sync(localSettings.pumpUIDs)
+
+    refreshDesiredStates()
+
+    # added pumps are in end of list, in same order
+    newPumpId = len(localSettings.pumps) - pumpUIDs.count(None)
+    for pumpIdx in range(len(pumpUIDs)):
+        if pumpUIDs[pumpIdx] is None:
+            pumpUIDs[pumpIdx] = localSettings.pumps[newPumpId].uid
+            newPumpId += 1
+
+    # keep data-base history of renamed pumps, tables of new pumps are created when first written
+    if withDBLogger and localSettings.options['PumpDBLog'] and len(pumpRenames) > 0:
+        dbDefinitions = db_logger_read_definitions()
+        for oldName, newName in pumpRenames:
+            create_generic_table("advance_pump_" + oldName, dbTableElements, dbDefinitions)
+            create_generic_table("advance_pump_logs_" + oldName, dbLogsTableElements, dbDefinitions)
+            change_table_name("advance_pump_" + oldName, "advance_pump_" + newName, dbDefinitions)
+            change_table_name("advance_pump_logs_" + oldName, "advance_pump_logs_" + newName, dbDefinitions)
+        queueDBEvent('reset', u"", None)
+
+    wakeControlLoop()
+    scheduleSettingsWrite(localSettings)
+
+    return localSettings, pumpUIDs, []
+
+def getConfig(localSettings):
+    """ Options and pumps of settings in JSON configuration format, answer could be sent back with changes"""
+    pumpsConfig = []
+    for pump in localSettings.pumps:
+        pumpConfig = pump._asdict()
+        for fieldName in configValveFields:
+            pumpConfig[fieldName] = list(pumpConfig[fieldName])
+        pumpsConfig.append(pumpConfig)
+
+    # secret options are write only
+    return {'version': localSettings.version, 'options': dict((optionKey, localSettings.options[optionKey]) for optionKey in configOptionKeys if optionKey not in secretSettingKeys), 'pumps': pumpsConfig}
+
+# settings are read by control thread, plugin import only register URLs and signals
+settingsLoaded = Event()
+settingsLoadTimeout = 10 # seconds that pages wait for settings in plugin start
+
+def waitSettingsLoaded():
+    """ Pages that show or change settings wait first load, changes before it would save default settings"""
+    settingsLoaded.wait(settingsLoadTimeout)
 
-    mutexAdvPump.release()
+def load_advance_pump():
+    """ Start control thread, it load settings and start other threads before first tick"""
+    global threadMain
 
     # tread to check if pupm is on-line
     threadMain = Thread(target = runTreadPump)
     threadMain.start()
 
-load_advance_pump()
+# Read in the commands for this plugin from it's JSON file
+def warmUpAdvancePump():
+    global mutexAdvPump, stateAdvPump, threadDBWriter, threadSettingsWriter
 
-#### output command when signal received ####
-def on_zone_change_pump(name, **kw):
-    global pumpsStateVect, mutexAdvPump
+    # requests is imported in poll pool, first sweep wait it and control thread do not
+    poolAdvPump.submit(loadHTTPStack)
 
-    """ Send command when core program signals a change in station state."""
-    mutexAdvPump.acquire()    
+    settingsAdvancePump, settingsChanged = readSettingsFile()
+    if settingsAdvancePump is None:
+        # write default values to files
+        settingsAdvancePump = copy.deepcopy(defaultSettingsAdvancePump)
 
-    for pumpId in range(len(settingsAdvancePump['PumpName'])):
-        anyValveNeedPump = False
+    # settings saved by older versions get default values in snapshot
+    localSettings = publishSettings(settingsAdvancePump)
+
+    stateAdvPump.sync(localSettings.pumpUIDs)
+
+    # tread to save settings file
+    threadSettingsWriter = Thread(target = runThreadSettingsWriter)
+    threadSettingsWriter.daemon = True
+    threadSettingsWriter.start()
+
+    # new or older file is saved with uid of pumps and current version
+    if settingsChanged:
+        scheduleSettingsWrite(localSettings)
+
+    # tread to save pumps events in data-base, definitions are read in first write
+    if withDBLogger:
+        threadDBWriter = Thread(target = runThreadDBWriter)
+        threadDBWriter.daemon = True
+        threadDBWriter.start()
+
+    settingsLoaded.set()
 
-        # check if any valve need pump working to have water
-        for valveIdNeedPump in settingsAdvancePump['PumpNeedValves'][pumpId]:
-            if valveIdNeedPump < len(gv.srvals) and gv.srvals[valveIdNeedPump]:
-                anyValveNeedPump = True
+    # valves could be on if plugin is reloaded, pumps start without wait for next zone change
+    on_zone_change_pump(u"advance_pump")
 
-        # check if every valves are open to flow wather when pump is working
-        for valveIdNeedOnPump in settingsAdvancePump['PumpNeedValvesOn'][pumpId]:
-            if valveIdNeedOnPump < len(gv.srvals) and not gv.srvals[valveIdNeedOnPump]:
-                anyValveNeedPump = False
+def pumpNeedByValves(pumpMasks, valvesMask : int, existValvesMask : int):
+    """ Check if pump must work with valves state, masks of valves that need pump, must be on and must be off"""
+    needMask, needOnMask, needOffMask = pumpMasks
 
-        # check if every valves are close to flow wather when pump is working
-        for valveIdNeedOffPump in settingsAdvancePump['PumpNeedValvesOff'][pumpId]:
-            if valveIdNeedOffPump < len(gv.srvals) and not gv.srvals[valveIdNeedOffPump]:
-                anyValveNeedPump = False
+    # check if any valve need pump working to have water
+    anyValveNeedPump = (valvesMask & needMask) != 0
 
-        pumpsStateVect[pumpId] = anyValveNeedPump
+    # check if every valves are open to flow wather when pump is working
+    needOnMask &= existValvesMask
+    if (valvesMask & needOnMask) != needOnMask:
+        anyValveNeedPump = False
+
+    # check if every valves are close to flow wather when pump is working
+    if (valvesMask & needOffMask) != 0:
+        anyValveNeedPump = False
 
-    mutexAdvPump.release()
+    return anyValveNeedPump
+
+#### output command when signal received ####
+def on_zone_change_pump(name, **kw):
+    global stateAdvPump, mutexZoneChange, lastValvesMask
+
+    """ Send command when core program signals a change in station state."""
+    # valves state as bit mask, bit sid is on if valve sid is open
+    valvesMask = 0
+    for sid in range(len(gv.srvals)):
+        if gv.srvals[sid]:
+            valvesMask |= 1 << sid
+    existValvesMask = (1 << len(gv.srvals)) - 1
+
+    localSettings = snapshotAdvPump
+
+    # only zone changes use this lock, web pages and control thread do not delay signal
+    with mutexZoneChange:
+        if lastValvesMask is None or lastValvesMask[0] != localSettings.version or lastValvesMask[2] != existValvesMask:
+            # first signal or new settings, check all pumps
+            pumps2Check = range(len(localSettings.pumpMasks))
+        else:
+            # only pumps that depend of valves that change
+            pumps2Check = set()
+            changedMask = valvesMask ^ lastValvesMask[1]
+            while changedMask:
+                lowBit = changedMask & -changedMask
+                pumps2Check.update(localSettings.valvesIndex.get(lowBit.bit_length() - 1, ()))
+                changedMask ^= lowBit
+        lastValvesMask = (localSettings.version, valvesMask, existValvesMask)
+
+        desiredStates = {}
+        for pumpId in pumps2Check:
+            desiredStates[localSettings.pumpUIDs[pumpId]] = pumpNeedByValves(localSettings.pumpMasks[pumpId], valvesMask, existValvesMask)
+
+        stateAdvPump.setDesired(desiredStates)
+
+    wakeControlLoop()
     return
 
+def refreshDesiredStates():
+    """
+    Check all pumps again after settings change, with new valves rules and new pumps.
+    Zone change between new settings and store sync could save new version without new pumps, all pumps are checked after sync
+    """
+    global lastValvesMask
+
+    with mutexZoneChange:
+        lastValvesMask = None
+
+    on_zone_change_pump(u"advance_pump")
+
 zones = signal(u"zone_change")
 zones.connect(on_zone_change_pump)
 
@@ -329,26 +2818,38 @@ def restart_pump_clean_up(name, **kw):
     global threadMain, isRuning
     if threadMain != None and threadMain.is_alive():
         isRuning = False
+        wakeControlLoop()
+        notifyStateChange()
         threadMain.join()
+    # requests waiting in pool are not sent, sessions are closed and running requests do not wait answer
+    poolAdvPump.shutdown(wait = False, cancel_futures = True)
+    poolCommands.shutdown(wait = False, cancel_futures = True)
+    stopMQTT(5)
+    stopDBWriter(10)
+    stopSettingsWriter(10)
+    setHTTPConfig(snapshotAdvPump.options)
 
 rebootAction = signal(u"restarting")
 rebootAction.connect(restart_pump_clean_up)
 
+load_advance_pump()
+
 class home(ProtectedPage):
     """
     Load an html page for entering plugin settings.
     """
 
     def GET(self):
-        settings = {}
-        global settingsAdvancePump, mutexAdvPump, advancePumpManualMode
+        global mutexAdvPump, advancePumpManualMode
+
+        waitSettingsLoaded()
 
-        mutexAdvPump.acquire()
-        settings = copy.deepcopy(settingsAdvancePump)
-        advancePumpManualModeLocal = copy.deepcopy(advancePumpManualMode)
-        mutexAdvPump.release()
+        localSettings = snapshotAdvPump
 
-        return template_render.advance_pump_home(settings, advancePumpManualModeLocal)  # open settings page
+        # page use position of pump in list
+        advancePumpManualModeLocal = dict((localSettings.uidIndex[pumpUID], manualMode) for pumpUID, manualMode in advancePumpManualMode.items() if pumpUID in localSettings.uidIndex)
+
+        return template_render.advance_pump_home(localSettings, advancePumpManualModeLocal)  # open settings page
 
 class settings(ProtectedPage):
     """
@@ -356,11 +2857,13 @@ class settings(ProtectedPage):
     """
 
     def GET(self):
-        global mutexAdvPump, settingsAdvancePump, withDBLogger
+        global withDBLogger
+
+        waitSettingsLoaded()
 
-        mutexAdvPump.acquire()
-        settingsAdvancePumpLocal = copy.deepcopy(settingsAdvancePump)
-        mutexAdvPump.release()
+        settingsAdvancePumpLocal = snapshotAdvPump.to_dict()
+        for settingKey in secretSettingKeys:
+            del settingsAdvancePumpLocal[settingKey]
 
         qdict = web.input()
 
@@ -368,7 +2871,9 @@ class settings(ProtectedPage):
         if "AddPumps" in qdict:
             addPump = int(qdict["AddPumps"])
 
-        return template_render.advance_pump(settingsAdvancePumpLocal, addPump, withDBLogger)  # open settings page
+        pumpDeviceTypes = [(deviceType, pumpDrivers[deviceType].label) for deviceType in pumpDrivers]
+
+        return template_render.advance_pump(settingsAdvancePumpLocal, addPump, withDBLogger, pumpDeviceTypes)  # open settings page
 
 class save_settings(ProtectedPage):
     """
@@ -376,11 +2881,11 @@ class save_settings(ProtectedPage):
     """
 
     def GET(self):
-        global settingsAdvancePump, mutexAdvPump, pumpsStateVect, lasTimeOnLine, switchPumpStatus
+        global mutexAdvPump, stateAdvPump
 
-        mutexAdvPump.acquire()
-        settingsAdvancePumpTMP = copy.deepcopy(settingsAdvancePump)
-        mutexAdvPump.release()
+        waitSettingsLoaded()
+
+        settingsAdvancePumpTMP = snapshotAdvPump.to_dict()
 
         qdict = web.input()
 
@@ -397,8 +2902,8 @@ class save_settings(ProtectedPage):
             dbDefinitions = {}
 
         # Get name of pupms
-        listElements = {"AdvancePumpDateBegin": "datetime", "AdvancePumpDateEnd": "datetime"}
-        listElementsEvents = {"AdvancePumpLogsDate": "datetime", "AdvancePumpLogsData": "text"}
+        listElements = dbTableElements
+        listElementsEvents = dbLogsTableElements
 
         for pumpId in range(initialSize + addNew):
             if "pumpName" + str(pumpId) in qdict:
@@ -420,8 +2925,9 @@ class save_settings(ProtectedPage):
                 else:
                     settingsAdvancePumpTMP['PumpName'].append(qdict["pumpName" + str(pumpId)])
 
-                    create_generic_table("advance_pump_" + qdict["pumpName" + str(pumpId)], listElements, dbDefinitions)
-                    create_generic_table("advance_pump_logs_" + qdict["pumpName" + str(pumpId)], listElementsEvents, dbDefinitions)
+                    if withDBLogger and settingsAdvancePumpTMP['PumpDBLog']:
+                        create_generic_table("advance_pump_" + qdict["pumpName" + str(pumpId)].strip(), listElements, dbDefinitions)
+                        create_generic_table("advance_pump_logs_" + qdict["pumpName" + str(pumpId)].strip(), listElementsEvents, dbDefinitions)
 
         # pump device type
         for pumpId in range(initialSize + addNew):
@@ -439,6 +2945,14 @@ class save_settings(ProtectedPage):
                 else:
                     settingsAdvancePumpTMP['PumpIP'].append(qdict["deviceIP" + str(pumpId)])
 
+        # MQTT topic prefix of device, empty to use only HTTP
+        for pumpId in range(initialSize + addNew):
+            if "deviceMQTTId" + str(pumpId) in qdict:
+                if pumpId < initialSize:
+                    settingsAdvancePumpTMP['PumpMQTTId'][pumpId] = qdict["deviceMQTTId" + str(pumpId)].strip()
+                else:
+                    settingsAdvancePumpTMP['PumpMQTTId'].append(qdict["deviceMQTTId" + str(pumpId)].strip())
+
         # check if pupm to keep state
         for pumpId in range(initialSize + addNew):
             if pumpId < initialSize:
@@ -447,53 +2961,16 @@ class save_settings(ProtectedPage):
                 settingsAdvancePumpTMP['PumpKeepState'].append("deviceForceState" + str(pumpId) in qdict)
 
 
-        # Get list of valves need of working of pump
-        for pumpId in range(initialSize + addNew):
-            listValves = []
-            for bid in range(0,gv.sd['nbrd']):
-                for s in range(0,8):
-                    sid = bid*8 + s
-                    if 'valvesNeedPump' + str(pumpId) + 'Valve' + str(sid) in qdict:
-                        # valve must be active
-                        listValves.append(sid)
-            if pumpId < initialSize:
-                # update exist
-                settingsAdvancePumpTMP['PumpNeedValves'][pumpId] = listValves
-            else:
-                # add new
-                settingsAdvancePumpTMP['PumpNeedValves'].append(listValves)
-
-        # anly allow pump work if valve is on
-        for pumpId in range(initialSize + addNew):
-            listValves = []
-            for bid in range(0,gv.sd['nbrd']):
-                for s in range(0,8):
-                    sid = bid*8 + s
-                    if 'valvesNeedPump' + str(pumpId) + 'ON' + str(sid) in qdict:
-                        # valve must be active
-                        listValves.append(sid)
-            if pumpId < initialSize:
-                # update exist
-                settingsAdvancePumpTMP['PumpNeedValvesOn'][pumpId] = listValves
-            else:
-                # add new
-                settingsAdvancePumpTMP['PumpNeedValvesOn'].append(listValves)
-
-        # anly allow pump work if valve is off
-        for pumpId in range(initialSize + addNew):
-            listValves = []
-            for bid in range(0,gv.sd['nbrd']):
-                for s in range(0,8):
-                    sid = bid*8 + s
-                    if 'valvesNeedPump' + str(pumpId) + 'Off' + str(sid) in qdict:
-                        # valve must be active
-                        listValves.append(sid)
-            if pumpId < initialSize:
-                # update exist
-                settingsAdvancePumpTMP['PumpNeedValvesOff'][pumpId] = listValves
-            else:
-                # add new
-                settingsAdvancePumpTMP['PumpNeedValvesOff'].append(listValves)
+        # valves that need pump, and valves that must be on or off to pump work. One pass in form keys
+        formValves = parseFormValves(qdict, initialSize + addNew, gv.sd['nbrd'] * 8)
+        for fileKey in formValves:
+            for pumpId in range(initialSize + addNew):
+                if pumpId < initialSize:
+                    # update exist
+                    settingsAdvancePumpTMP[fileKey][pumpId] = formValves[fileKey][pumpId]
+                else:
+                    # add new
+                    settingsAdvancePumpTMP[fileKey].append(formValves[fileKey][pumpId])
 
         # pump power use in working mode
         for pumpId in range(initialSize + addNew):
@@ -516,38 +2993,73 @@ class save_settings(ProtectedPage):
                 else:
                     settingsAdvancePumpTMP['PumpMinWorkingTime'].append(qdict['deviceMinTime' + str(pumpId)])
 
-        mutexAdvPump.acquire()
-        settingsAdvancePump = copy.deepcopy(settingsAdvancePumpTMP)
-        if len(settingsAdvancePump['PumpName']) > len(pumpsStateVect):
-            sizeOfIncrementVect = len(settingsAdvancePump['PumpName']) - len(pumpsStateVect)
+        # pump priority to get power, small number start first
+        for pumpId in range(initialSize + addNew):
+            if 'devicePriority' + str(pumpId) in qdict:
+                try:
+                    pumpPriority = int(qdict['devicePriority' + str(pumpId)])
+                except ValueError:
+                    pumpPriority = 0
 
-            increase = [False] * sizeOfIncrementVect
-            pumpsStateVect.extend(increase)
+                if pumpId < initialSize:
+                    settingsAdvancePumpTMP['PumpPriority'][pumpId] = pumpPriority
+                else:
+                    settingsAdvancePumpTMP['PumpPriority'].append(pumpPriority)
 
-            increase = [datetime.now()] * sizeOfIncrementVect
-            lasTimeOnLine.extend(increase)
+        # pump minimum time to keep off, avoid to much start ups
+        for pumpId in range(initialSize + addNew):
+            if 'deviceMinOffTime' + str(pumpId) in qdict:
+                if pumpId < initialSize:
+                    settingsAdvancePumpTMP['PumpMinOffTime'][pumpId] = qdict['deviceMinOffTime' + str(pumpId)]
+                else:
+                    settingsAdvancePumpTMP['PumpMinOffTime'].append(qdict['deviceMinOffTime' + str(pumpId)])
+
+        # device connection parameters
+        for configKey, configType in [('PumpStartStagger', float), ('PumpPowerBudget', float), ('PumpLeaseTime', int), ('PumpLookahead', float), ('PumpHTTPPoolSize', int), ('PumpHTTPConnectTimeout', float), ('PumpHTTPReadTimeout', float), ('PumpHTTPRetries', int), ('PumpHTTPBackoff', float), ('PumpMQTTPort', int)]:
+            if configKey in qdict:
+                try:
+                    settingsAdvancePumpTMP[configKey] = max(configType(qdict[configKey]), 0)
+                except ValueError:
+                    pass
+        settingsAdvancePumpTMP['PumpHTTPPoolSize'] = max(settingsAdvancePumpTMP['PumpHTTPPoolSize'], 1)
+        for configKey in ['PumpMQTTHost', 'PumpMQTTUser']:
+            if configKey in qdict:
+                settingsAdvancePumpTMP[configKey] = qdict[configKey].strip()
+
+        # password is not sent to page, empty field keep saved password and it is removed with user
+        if qdict.get('PumpMQTTPassword', u"") != u"":
+            settingsAdvancePumpTMP['PumpMQTTPassword'] = qdict['PumpMQTTPassword']
+        elif settingsAdvancePumpTMP['PumpMQTTUser'] == u"":
+            settingsAdvancePumpTMP['PumpMQTTPassword'] = u""
+
+        # tables could be renamed, data-base writer must check them again
+        if withDBLogger:
+            queueDBEvent('reset', u"", None)
 
-            increase = [False] * sizeOfIncrementVect
-            switchPumpStatus.extend(increase)
-        elif len(settingsAdvancePump['PumpName']) < len(pumpsStateVect):
-            pumpsStateVect = pumpsStateVect[:len(settingsAdvancePump['PumpName'])]
-            lasTimeOnLine = lasTimeOnLine[:len(settingsAdvancePump['PumpName'])]
-            switchPumpStatus = switchPumpStatus[:len(settingsAdvancePump['PumpName'])]
-        mutexAdvPump.release()
+        with mutexAdvPump:
+            localSettings = publishSettings(settingsAdvancePumpTMP)
+            stateAdvPump.sync(localSettings.pumpUIDs)
 
-        # save new configuration to file
-        with open(u"./data/advance_pump.json", u"w") as f:  # write the settings to file
-            json.dump(settingsAdvancePumpTMP, f, indent=4)
+        refreshDesiredStates()
+
+        # save new configuration to file, with uid given to new pumps
+        scheduleSettingsWrite(localSettings)
 
         web.seeother(u"/advance-pump-set")  # Return to definition pannel
 
+    def POST(self):
+        # form is sent by POST, big installations do not fit in URL
+        return self.GET()
+
 class delete_pump(ProtectedPage):
     """
     Delete pump
     """
 
     def GET(self):
-        global settingsAdvancePump, mutexAdvPump, pumpsStateVect, lasTimeOnLine, switchPumpStatus
+        global mutexAdvPump, stateAdvPump, advancePumpManualMode
+
+        waitSettingsLoaded()
 
         qdict = web.input()
 
@@ -555,26 +3067,30 @@ class delete_pump(ProtectedPage):
         if "PumpId" in qdict:
             pump2Delete = int(qdict["PumpId"])
 
-        mutexAdvPump.acquire()
-        if pump2Delete < len(pumpsStateVect):
-            del pumpsStateVect[pump2Delete]
-            del lasTimeOnLine[pump2Delete]
-            del switchPumpStatus[pump2Delete]
+        localSettings = snapshotAdvPump
+        settingsAdvancePumpTMP = localSettings.to_dict()
+
+        with mutexAdvPump:
+            if pump2Delete >= 0 and pump2Delete < len(settingsAdvancePumpTMP['PumpName']):
+                pumpUID = localSettings.pumpUIDs[pump2Delete]
+
+                for fileKey, recordField, defaultValue in pumpRecordFields:
+                    del settingsAdvancePumpTMP[fileKey][pump2Delete]
 
-            del settingsAdvancePump['PumpName'][pump2Delete]
-            del settingsAdvancePump['PumpDeviceType'][pump2Delete]
-            del settingsAdvancePump['PumpIP'][pump2Delete]
-            del settingsAdvancePump['PumpNeedValves'][pump2Delete]
-            del settingsAdvancePump['PumpNeedValvesOn'][pump2Delete]
-            del settingsAdvancePump['PumpNeedValvesOff'][pump2Delete]
-            del settingsAdvancePump['PumpKeepState'][pump2Delete]
+                localSettings = publishSettings(settingsAdvancePumpTMP)
+                stateAdvPump.sync(localSettings.pumpUIDs)
 
-            settingsAdvancePumpTMP = copy.deepcopy(settingsAdvancePump)
-        mutexAdvPump.release()
+                # only deleted pump state is removed, other pumps keep uid
+                pendingCommands.pop(pumpUID, None)
+                commandFailures.pop(pumpUID, None)
+                pumpSwitchTimes.pop(pumpUID, None)
+                advancePumpManualMode = dict((manualUID, manualMode) for manualUID, manualMode in advancePumpManualMode.items() if manualUID != pumpUID)
+                releasePumpPower(pumpUID)
 
-        # save new configuration to file
-        with open(u"./data/advance_pump.json", u"w") as f:  # write the settings to file
-            json.dump(settingsAdvancePumpTMP, f, indent=4)
+                # save new configuration to file
+                scheduleSettingsWrite(localSettings)
+
+        refreshDesiredStates()
 
         web.seeother(u"/advance-pump-set")  # Return to definition pannel
 
@@ -584,23 +3100,20 @@ class pump_is_online(ProtectedPage):
     """
 
     def GET(self):
-        global mutexAdvPump, lasTimeOnLine
+        global stateAdvPump
 
         qdict = web.input()
         if "PumpId" in qdict:
             idxPump = int(qdict["PumpId"])
-            currentDatime = datetime.now()
-            mutexAdvPump.acquire()
-            if idxPump >= 0 and idxPump < len(lasTimeOnLine):
-                lastSeen = lasTimeOnLine[idxPump]
-            else:
-                lastSeen = datetime.now()
+            localSettings = snapshotAdvPump
+
+            pumpState = None
+            if idxPump >= 0 and idxPump < len(localSettings.pumps):
+                pumpState = stateAdvPump.read(localSettings.pumpUIDs[idxPump])
+            if pumpState is None:
                 return "<b style=\"color:gray;\">NONE</b>"
-            mutexAdvPump.release()
 
-            diffTime = currentDatime - lastSeen
-            secondsInt = int(diffTime.seconds)
-            if secondsInt > 45:
+            if pumpState.health == pumpOffline:
                 return "<b style=\"color:red;\">OFFLINE</b>"
             else:
                 return "<b style=\"color:green;\">ONLINE</b>"
@@ -613,21 +3126,21 @@ class pump_is_on(ProtectedPage):
     """
 
     def GET(self):
-        global mutexAdvPump, lasTimeOnLine, switchPumpStatus
+        global stateAdvPump
 
         qdict = web.input()
         if "PumpId" in qdict:
             idxPump = int(qdict["PumpId"])
-            mutexAdvPump.acquire()
-            if idxPump >= 0 and idxPump < len(lasTimeOnLine):
-                if switchPumpStatus[idxPump]:
-                    mutexAdvPump.release()
-                    return "<b style=\"color:green;\">ON</b>"
-                else:
-                    mutexAdvPump.release()
-                    return "<b style=\"color:red;\">OFF</b>"
+            localSettings = snapshotAdvPump
+
+            pumpState = None
+            if idxPump >= 0 and idxPump < len(localSettings.pumps):
+                pumpState = stateAdvPump.read(localSettings.pumpUIDs[idxPump])
 
-            mutexAdvPump.release()
+            if pumpState is not None and pumpState.switchOn:
+                return "<b style=\"color:green;\">ON</b>"
+            elif pumpState is not None:
+                return "<b style=\"color:red;\">OFF</b>"
 
         return "<b style=\"color:gray;\">NONE</b>"
 
@@ -637,45 +3150,30 @@ class pump_change_manual_state(ProtectedPage):
     """
 
     def GET(self):
-        global mutexAdvPump, lasTimeOnLine, switchPumpStatus, settingsAdvancePump
+        global mutexAdvPump, advancePumpManualMode
+
+        waitSettingsLoaded()
 
         qdict = web.input()
         if "PumpId" in qdict:
             idxPump = int(qdict["PumpId"])
-            if "ChangeStateState" in qdict:
-                mutexAdvPump.acquire()
-                if qdict["ChangeStateState"] == 'auto' and idxPump in advancePumpManualMode:
-                    del advancePumpManualMode[idxPump]
-                elif qdict["ChangeStateState"] == 'on':
-                    advancePumpManualMode[idxPump] = True
-                elif qdict["ChangeStateState"] == 'off':
-                    advancePumpManualMode[idxPump] = False
-
-                pumpType = settingsAdvancePump['PumpDeviceType'][idxPump]
-                pumpIP = settingsAdvancePump['PumpIP'][idxPump]
-                mutexAdvPump.release()
-
-                if qdict["ChangeStateState"] == 'on':
-                    # send on signal
-                    #pupmpAction(pumpType, pumpIP, True)
-                    pass
-                elif qdict["ChangeStateState"] == 'off':
-                    # send off signal
-                    #pupmpAction(pumpType, pumpIP, False)
-                    pass
-
-                if qdict["ChangeStateState"] == 'on' or qdict["ChangeStateState"] == 'off':
-                    # check status
-                    resposeIsOk, isTurnOn = pumpIsOnLine(pumpType, pumpIP)
-
-                    mutexAdvPump.acquire()
-                    if resposeIsOk == 0:
-                        lasTimeOnLine[idxPump] = datetime.now()
-
-                        switchPumpStatus[idxPump] = isTurnOn
-                    else:
-                        switchPumpStatus[idxPump] = False
-                    mutexAdvPump.release()
+            if "ChangeStateState" in qdict and idxPump >= 0 and idxPump < len(snapshotAdvPump.pumps):
+                pumpUID = snapshotAdvPump.pumpUIDs[idxPump]
+
+                # new dictionary, readers keep old one without lock
+                with mutexAdvPump:
+                    newManualMode = dict(advancePumpManualMode)
+                    if qdict["ChangeStateState"] == 'auto' and pumpUID in newManualMode:
+                        del newManualMode[pumpUID]
+                    elif qdict["ChangeStateState"] == 'on':
+                        newManualMode[pumpUID] = True
+                    elif qdict["ChangeStateState"] == 'off':
+                        newManualMode[pumpUID] = False
+                    advancePumpManualMode = newManualMode
+
+                # control thread send command, device answer update switch state
+                wakeControlLoop()
+                notifyStateChange()
 
                 # return next state
                 if qdict["ChangeStateState"] == 'on':
@@ -689,14 +3187,185 @@ class pump_change_manual_state(ProtectedPage):
 
 class pump_get_list(ProtectedPage):
     """
-    change manual mode pumps states
+    Settings of all pumps in json, built only when settings change. Same version give not modified
+    """
+
+    def GET(self):
+        listPayload = listPayloadAdvPump
+
+        web.header(u"Content-Type", u"application/json")
+        web.header(u"Cache-Control", u"no-cache")
+        web.header(u"ETag", listPayload.tag)
+        web.header(u"Last-Modified", listPayload.lastModified)
+        web.header(u"Vary", u"Accept-Encoding")
+
+        # tag is checked first, date only if client do not send tag
+        noneMatch = web.ctx.env.get(u"HTTP_IF_NONE_MATCH")
+        if noneMatch is not None:
+            if listPayload.tag in [clientTag.strip() for clientTag in noneMatch.split(u",")] or noneMatch.strip() == u"*":
+                raise web.notmodified()
+        elif web.ctx.env.get(u"HTTP_IF_MODIFIED_SINCE") == listPayload.lastModified:
+            raise web.notmodified()
+
+        if listPayload.gzipBody is not None and u"gzip" in web.ctx.env.get(u"HTTP_ACCEPT_ENCODING", u""):
+            web.header(u"Content-Encoding", u"gzip")
+            return listPayload.gzipBody
+
+        return listPayload.body
+
+class pump_get_status(ProtectedPage):
+    """
+    Status of all pumps in json, same answer give not modified
+    """
+
+    def GET(self):
+        pumpsStatus = getPumpsStatus()
+        statusJSON = json.dumps(pumpsStatus, sort_keys = True)
+
+        # tag is from state only, without version and last seen time that change in each device answer. Health change the tag when pump stop answer
+        del pumpsStatus['stateVersion']
+        for pumpStatus in pumpsStatus['pumps']:
+            del pumpStatus['lastSeen']
+        statusTag = '"' + hashlib.md5(json.dumps(pumpsStatus, sort_keys = True).encode('utf-8')).hexdigest() + '"'
+
+        web.header(u"Content-Type", u"application/json")
+        web.header(u"Cache-Control", u"no-cache")
+        web.header(u"ETag", statusTag)
+
+        if web.ctx.env.get(u"HTTP_IF_NONE_MATCH") == statusTag:
+            raise web.notmodified()
+
+        return statusJSON
+
+class pump_wait_status(ProtectedPage):
+    """
+    Status of all pumps in json, answer only when state is different of client version or wait timeout.
+    Answer 503 with Retry-After if client cannot wait
     """
 
     def GET(self):
-        global settingsAdvancePump
+        qdict = web.input()
+
+        knownVersion = -1
+        if "Version" in qdict:
+            try:
+                knownVersion = int(qdict["Version"])
+            except ValueError:
+                pass
+
+        web.header(u"Cache-Control", u"no-store")
+
+        # client not admitted to wait, it use status with ETag and try to wait again later
+        if waitStateChange(knownVersion, stateWaitTimeout) is None:
+            web.ctx.status = "503 Service Unavailable"
+            web.header(u"Retry-After", str(stateWaitTimeout))
+            return u""
+
+        web.header(u"Content-Type", u"application/json")
+
+        return json.dumps(getPumpsStatus())
+
+class pump_get_metrics(ProtectedPage):
+    """
+    Metrics of plugin in Prometheus text format, in json with Format=json
+    """
+
+    def GET(self):
+        qdict = web.input()
+
+        web.header(u"Cache-Control", u"no-store")
+
+        if qdict.get("Format") == "json":
+            web.header(u"Content-Type", u"application/json")
+            return json.dumps(getMetrics(), sort_keys = True)
+
+        web.header(u"Content-Type", u"text/plain; version=0.0.4")
+        return formatPrometheusMetrics(getMetrics())
+
+class pump_profile(ProtectedPage):
+    """
+    Sample control thread during Seconds (default 10) and return folded stacks, one line 'stack samples' to build flame graphs
+    """
+
+    def GET(self):
+        qdict = web.input()
+
+        profileSeconds = 10.0
+        if "Seconds" in qdict:
+            try:
+                profileSeconds = float(qdict["Seconds"])
+            except ValueError:
+                pass
+
+        stackSamples = profileControlThread(profileSeconds)
+
+        web.header(u"Content-Type", u"text/plain")
+        web.header(u"Cache-Control", u"no-store")
+
+        if stackSamples is None:
+            return u"other profile is running\n"
+
+        return u"".join(stackKey + u" " + str(stackSamples[stackKey]) + u"\n" for stackKey in sorted(stackSamples, key = lambda stackKey: -stackSamples[stackKey]))
+
+class pump_config(ProtectedPage):
+    """
+    JSON configuration, GET return options and pumps, POST change options and pumps given in body
+    """
+
+    def GET(self):
+        waitSettingsLoaded()
+
+        web.header(u"Content-Type", u"application/json")
+        web.header(u"Cache-Control", u"no-store")
+
+        return json.dumps(getConfig(snapshotAdvPump), sort_keys = True)
+
+    def POST(self):
+        waitSettingsLoaded()
+
+        web.header(u"Content-Type", u"application/json")
+        web.header(u"Cache-Control", u"no-store")
+
+        try:
+            configUpdate = json.loads(web.data())
+        except ValueError as e:
+            web.ctx.status = u"400 Bad Request"
+            return json.dumps({'errors': [u"invalid JSON: " + str(e)]})
+
+        localSettings, pumpUIDs, configErrors = applyConfigUpdate(configUpdate)
+        if localSettings is None:
+            web.ctx.status = u"400 Bad Request"
+            return json.dumps({'errors': configErrors})
+
+        return json.dumps({'version': localSettings.version, 'uids': pumpUIDs})
+
+class pump_get_history(ProtectedPage):
+    """
+    Run time, energy and availability of pumps in buckets of Resolution (minute, hour or day), last Count buckets.
+    PumpId to only one pump, answer from memory without data-base
+    """
+
+    def GET(self):
+        qdict = web.input()
+        localSettings = snapshotAdvPump
+
+        resolution = qdict.get("Resolution", u"hour")
+        if resolution not in historyResolutions:
+            resolution = u"hour"
+
+        try:
+            count = int(qdict.get("Count", 24))
+        except ValueError:
+            count = 24
+
+        pumpIds = range(len(localSettings.pumps))
+        if "PumpId" in qdict:
+            try:
+                pumpIds = [pumpId for pumpId in [int(qdict["PumpId"])] if 0 <= pumpId < len(localSettings.pumps)]
+            except ValueError:
+                pumpIds = []
 
-        mutexAdvPump.acquire()
-        y = json.dumps(settingsAdvancePump)
-        mutexAdvPump.release()
+        web.header(u"Content-Type", u"application/json")
+        web.header(u"Cache-Control", u"no-cache")
 
-        return y
+        return json.dumps(historyAdvPump.query(localSettings, resolution, count, pumpIds))
@@ -0,0 +1,249 @@
+"""
+Benchmark of advance pump plugin hot paths, without SIP and without real devices.
+SIP modules (gv, sip, urls, web, webpages) and blinker signals are replaced by small stubs,
+pumps are simulated Shelly devices from shelly_simulator.
+
+Run from repository root:
+    python benchmark/bench_advance_pump.py --pumps 50 --boards 8 --latency 0.02
+"""
+
+# Python 2/3 compatibility imports
+from __future__ import print_function
+
+# standard library imports
+import argparse
+import builtins
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+import types
+from time import sleep, monotonic, process_time
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchmarkDir)
+sys.path.insert(0, os.path.dirname(benchmarkDir))
+
+from shelly_simulator import SimulatedShelly
+from mqtt_standin import StandInBroker, installPahoStandIn, attachShelly
+
+class StubSignal(object):
+    """ Minimal blinker signal, receivers are called in sender thread"""
+
+    def __init__(self, name):
+        self.name = name
+        self.receivers = []
+
+    def connect(self, receiver):
+        self.receivers.append(receiver)
+        return receiver
+
+    def send(self, sender = None, **kw):
+        return [(receiver, receiver(sender, **kw)) for receiver in self.receivers]
+
+stubSignals = {}
+
+def stubSignal(name):
+    if name not in stubSignals:
+        stubSignals[name] = StubSignal(name)
+    return stubSignals[name]
+
+def installSIPStubs(nbrd):
+    """ Install modules imported by plugin, with only what plugin use"""
+    builtins._ = lambda text: text
+
+    gv = types.ModuleType("gv")
+    gv.sd = {'nbrd': nbrd}
+    gv.srvals = [0] * (nbrd * 8)
+    gv.snames = [u"S" + str(sid + 1) for sid in range(nbrd * 8)]
+    gv.plugin_menu = []
+    gv.rs = [[0, 0, 0, 0] for _ in range(nbrd * 8)]
+    gv.now = 0
+
+    sip = types.ModuleType("sip")
+    sip.template_render = types.SimpleNamespace()
+
+    urls = types.ModuleType("urls")
+    urls.urls = []
+
+    web = types.ModuleType("web")
+    web.ctx = types.SimpleNamespace(env = {}, status = "200 OK")
+    web.input = lambda *args, **kw: {}
+    web.header = lambda *args, **kw: None
+    web.seeother = lambda url: None
+    web.data = lambda: b""
+    web.notmodified = type("notmodified", (Exception,), {})
+
+    webpages = types.ModuleType("webpages")
+    webpages.ProtectedPage = object
+
+    blinker = types.ModuleType("blinker")
+    blinker.signal = stubSignal
+
+    for module in [gv, sip, urls, web, webpages, blinker]:
+        sys.modules[module.__name__] = module
+
+    return gv
+
+def percentiles(values, points = (50, 90, 99)):
+    """ Percentiles of list in milliseconds"""
+    if len(values) == 0:
+        return u"n/a"
+    values = sorted(values)
+    return u", ".join(u"p" + str(point) + u" " + u"%.2f" % (values[min(len(values) - 1, int(len(values) * point / 100))] * 1000) + u" ms" for point in points)
+
+def writeSettings(devices, channels, pumps, valves, stagger, lease = 0, mqtt = False):
+    """ Each pump need one valve, pump i is turned on by valve i. With mqtt, device d publish in topic shellies/device<d>"""
+    settings = {'PumpDBLog': False, 'PumpStartStagger': stagger, 'PumpLeaseTime': lease, 'PumpName': [], 'PumpDeviceType': [], 'PumpIP': [], 'PumpNeedValves': [], 'PumpNeedValvesOn': [], 'PumpNeedValvesOff': [], 'PumpKeepState': [], 'PumpPower': [], 'PumpMinWorkingTime': [], 'PumpMQTTId': []}
+    if mqtt:
+        settings['PumpMQTTHost'] = u"127.0.0.1"
+    for pumpId in range(pumps):
+        settings['PumpName'].append(u"Pump " + str(pumpId))
+        settings['PumpDeviceType'].append(u"shelly1")
+        settings['PumpIP'].append(devices[pumpId // channels].address + u"#" + str(pumpId % channels))
+        settings['PumpNeedValves'].append([pumpId % valves])
+        settings['PumpNeedValvesOn'].append([])
+        settings['PumpNeedValvesOff'].append([])
+        settings['PumpKeepState'].append(True)
+        settings['PumpPower'].append(1.0)
+        settings['PumpMinWorkingTime'].append(u"")
+        settings['PumpMQTTId'].append(u"shellies/device" + str(pumpId // channels) if mqtt else u"")
+
+    os.makedirs(u"data", exist_ok = True)
+    with open(u"./data/advance_pump.json", u"w") as f:
+        json.dump(settings, f)
+
+def waitRelayCommand(devices, sinceTime, timeout):
+    """ Time of first relay command after sinceTime, None if no command until timeout"""
+    endTime = monotonic() + timeout
+    while monotonic() < endTime:
+        for device in devices:
+            for commandTime, channel, state in list(device.commandLog):
+                if commandTime >= sinceTime:
+                    return commandTime
+        sleep(0.0005)
+    return None
+
+def benchZoneChange(plugin, gv, devices, iterations, valves):
+    """ Handler time and zone change to relay command latency"""
+    handlerTimes = []
+    relayLatencies = []
+    zones = stubSignal(u"zone_change")
+
+    for _ in range(iterations):
+        sid = random.randrange(valves)
+        gv.srvals[sid] = 0 if gv.srvals[sid] else 1
+
+        startTime = monotonic()
+        zones.send(u"bench")
+        handlerTimes.append(monotonic() - startTime)
+
+        commandTime = waitRelayCommand(devices, startTime, 0.5)
+        if commandTime is not None:
+            relayLatencies.append(commandTime - startTime)
+
+    return handlerTimes, relayLatencies
+
+def benchSweep(plugin, devices, sweeps):
+    """ Time to read status of all pumps"""
+    sweepTimes = []
+    requestsBefore = sum(device.statusRequests for device in devices)
+
+    for _ in range(sweeps):
+        startTime = monotonic()
+        sweepStart = monotonic()
+        sweepFutures = plugin.startPumpsSweep(plugin.snapshotAdvPump)
+        while not plugin.sweepIsFinished(sweepFutures, sweepStart):
+            sleep(0.0005)
+        plugin.applyPumpsSweep(sweepFutures)
+        sweepTimes.append(monotonic() - startTime)
+
+    return sweepTimes, (sum(device.statusRequests for device in devices) - requestsBefore) / float(max(sweeps, 1))
+
+def benchIdleCPU(seconds, devices):
+    """ CPU used by process and device status requests each second while plugin is idle"""
+    startCPU = process_time()
+    requestsBefore = sum(device.statusRequests for device in devices)
+    sleep(seconds)
+    return (process_time() - startCPU) / seconds, (sum(device.statusRequests for device in devices) - requestsBefore) / seconds
+
+def benchAllocations(plugin, gv, iterations, valves):
+    """ Memory allocated by zone change handler and status page"""
+    zones = stubSignal(u"zone_change")
+
+    tracemalloc.start()
+    startSnapshot = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        sid = random.randrange(valves)
+        gv.srvals[sid] = 0 if gv.srvals[sid] else 1
+        zones.send(u"bench")
+        plugin.getPumpsStatus()
+    endSnapshot = tracemalloc.take_snapshot()
+    currentSize, peakSize = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    allocatedBlocks = sum(stat.count_diff for stat in endSnapshot.compare_to(startSnapshot, 'filename') if stat.count_diff > 0)
+    return peakSize, allocatedBlocks
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark of advance pump plugin")
+    parser.add_argument("--pumps", type = int, default = 30, help = "number of pumps")
+    parser.add_argument("--channels", type = int, default = 1, help = "relays in each simulated device")
+    parser.add_argument("--boards", type = int, default = 4, help = "SIP boards, 8 valves each")
+    parser.add_argument("--latency", type = float, default = 0.01, help = "device answer time in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "device answer time variation in seconds")
+    parser.add_argument("--loss", type = float, default = 0.0, help = "fraction of device requests without answer")
+    parser.add_argument("--timeout-rate", type = float, default = 0.0, help = "fraction of device requests answered after timeout")
+    parser.add_argument("--stagger", type = float, default = 0.0, help = "seconds between pumps start")
+    parser.add_argument("--zone-changes", type = int, default = 200, help = "zone changes to measure")
+    parser.add_argument("--sweeps", type = int, default = 10, help = "status sweeps to measure")
+    parser.add_argument("--idle", type = float, default = 5.0, help = "seconds to measure idle CPU")
+    parser.add_argument("--lease", type = int, default = 0, help = "seconds of device auto-off lease of running pumps, 0 disabled")
+    parser.add_argument("--mqtt", action = "store_true", help = "devices publish state and receive commands by local broker stand-in")
+    args = parser.parse_args()
+
+    valves = args.boards * 8
+    deviceCount = (args.pumps + args.channels - 1) // args.channels
+    devices = [SimulatedShelly(channels = args.channels, latency = args.latency, jitter = args.jitter, lossRate = args.loss, timeoutRate = args.timeout_rate, timeoutTime = 10.0).start() for _ in range(deviceCount)]
+
+    workDir = tempfile.mkdtemp(prefix = "advance_pump_bench_")
+    os.chdir(workDir)
+    writeSettings(devices, args.channels, args.pumps, valves, args.stagger, args.lease, args.mqtt)
+
+    gv = installSIPStubs(args.boards)
+    if args.mqtt:
+        broker = StandInBroker()
+        installPahoStandIn(broker)
+        for deviceId in range(deviceCount):
+            attachShelly(broker, devices[deviceId], u"shellies/device" + str(deviceId))
+    importStart = monotonic()
+    import advance_pump as plugin
+    importTime = monotonic() - importStart
+    plugin.settingsLoaded.wait(10)
+    loadTime = monotonic() - importStart
+
+    try:
+        print("Pumps:", args.pumps, "devices:", deviceCount, "valves:", valves, "device latency:", args.latency, "s")
+        print("Plugin import: %.2f ms, settings loaded: %.2f ms" % (importTime * 1000, loadTime * 1000))
+
+        handlerTimes, relayLatencies = benchZoneChange(plugin, gv, devices, args.zone_changes, valves)
+        print("Zone change handler:", percentiles(handlerTimes))
+        print("Zone change to relay command:", percentiles(relayLatencies), "(" + str(len(relayLatencies)) + " commands)")
+
+        sweepTimes, requestsPerSweep = benchSweep(plugin, devices, args.sweeps)
+        print("Status sweep:", percentiles(sweepTimes), "- device requests per sweep:", requestsPerSweep)
+
+        idleCPU, idleRequests = benchIdleCPU(args.idle, devices)
+        print("Idle CPU: %.2f %%" % (idleCPU * 100), "- device status requests per second:", idleRequests)
+
+        peakSize, allocatedBlocks = benchAllocations(plugin, gv, args.zone_changes, valves)
+        print("Zone change + status allocations: peak", peakSize, "bytes,", allocatedBlocks, "blocks alive after run")
+    finally:
+        stubSignal(u"restarting").send(u"bench")
+        for device in devices:
+            device.stop()
+
+if __name__ == "__main__":
+    main()
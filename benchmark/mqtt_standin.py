@@ -0,0 +1,213 @@
+"""
+Local stand-in for MQTT broker, to test advance pump MQTT transport without broker and without paho-mqtt.
+Broker run in process and route messages by exact topic, clients have the part of paho client API used by plugin.
+Simulated Shelly devices are attached to broker: they receive commands and publish relay state like Gen1 and Gen2 devices.
+
+Use:
+    broker = StandInBroker()
+    installPahoStandIn(broker)
+    attachShelly(broker, device, u"shellies/pump0")
+"""
+
+# Python 2/3 compatibility imports
+from __future__ import print_function
+
+# standard library imports
+import json
+import queue
+import sys
+import threading
+import types
+
+mqttErrSuccess = 0
+mqttErrNoConn = 4
+mqttErrConnLost = 7
+
+class StandInBroker(object):
+    """
+    Broker in process, without retained messages and wildcards. With down set, connections are refused
+    """
+
+    def __init__(self):
+        self.subscriptions = {} # topic: list of clients or callbacks
+        self.clients = []
+        self.down = False
+        self.connects = 0
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def attach(self, client):
+        with self.lock:
+            if self.down:
+                raise ConnectionRefusedError("stand-in broker is down")
+            self.connects += 1
+            self.clients.append(client)
+
+    def detach(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            for subscribers in self.subscriptions.values():
+                if client in subscribers:
+                    subscribers.remove(client)
+
+    def subscribe(self, topic, subscriber):
+        """ Subscriber is client or function called with (topic, payload)"""
+        with self.lock:
+            self.subscriptions.setdefault(topic, []).append(subscriber)
+
+    def unsubscribe(self, topic, subscriber):
+        with self.lock:
+            if subscriber in self.subscriptions.get(topic, []):
+                self.subscriptions[topic].remove(subscriber)
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode(u"utf-8")
+
+        with self.lock:
+            self.published += 1
+            subscribers = list(self.subscriptions.get(topic, []))
+
+        message = types.SimpleNamespace(topic = topic, payload = payload, qos = 0, retain = False)
+        for subscriber in subscribers:
+            if isinstance(subscriber, StandInClient):
+                subscriber.messages.put(message)
+            else:
+                subscriber(topic, payload)
+
+    def disconnectAll(self):
+        """ Close all connections, like broker restart"""
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.lostConnection()
+
+class StandInClient(object):
+    """
+    Client with paho API used by plugin, callbacks are called in loop thread
+    """
+
+    def __init__(self, broker, clientId = u""):
+        self.broker = broker
+        self.clientId = clientId
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.connected = False
+        self.connectPending = False
+        self.messages = queue.Queue()
+
+    def username_pw_set(self, username, password = None):
+        self.username = username
+        self.password = password
+
+    def connect(self, host, port = 1883, keepalive = 60):
+        self.broker.attach(self)
+        self.connected = True
+        self.connectPending = True
+        return mqttErrSuccess
+
+    def loop(self, timeout = 1.0):
+        if not self.connected:
+            return mqttErrConnLost
+
+        if self.connectPending:
+            self.connectPending = False
+            if self.on_connect is not None:
+                self.on_connect(self, None, {}, 0)
+
+        try:
+            message = self.messages.get(timeout = timeout)
+        except queue.Empty:
+            return mqttErrSuccess
+
+        while message is not None:
+            if self.on_message is not None:
+                self.on_message(self, None, message)
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                message = None
+
+        return mqttErrSuccess if self.connected else mqttErrConnLost
+
+    def subscribe(self, topic, qos = 0):
+        self.broker.subscribe(topic, self)
+        return mqttErrSuccess, 1
+
+    def unsubscribe(self, topic):
+        self.broker.unsubscribe(topic, self)
+        return mqttErrSuccess, 1
+
+    def publish(self, topic, payload = None, qos = 0, retain = False):
+        if not self.connected:
+            return types.SimpleNamespace(rc = mqttErrNoConn)
+        self.broker.publish(topic, payload)
+        return types.SimpleNamespace(rc = mqttErrSuccess)
+
+    def disconnect(self):
+        self.broker.detach(self)
+        self.connected = False
+        self.messages.put(None)
+        return mqttErrSuccess
+
+    def lostConnection(self):
+        self.broker.detach(self)
+        self.connected = False
+        self.messages.put(None)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, mqttErrConnLost)
+
+def installPahoStandIn(broker):
+    """ Replace paho.mqtt.client module, clients connect to stand-in broker"""
+    paho = types.ModuleType("paho")
+    pahoMQTT = types.ModuleType("paho.mqtt")
+    pahoClient = types.ModuleType("paho.mqtt.client")
+
+    pahoClient.Client = lambda clientId = u"", *args, **kw: StandInClient(broker, clientId)
+    paho.mqtt = pahoMQTT
+    pahoMQTT.client = pahoClient
+
+    for module in [paho, pahoMQTT, pahoClient]:
+        sys.modules[module.__name__] = module
+
+def attachShelly(broker, device, mqttId, generation = 1):
+    """ Simulated device receive commands from broker and publish relay state after each change"""
+
+    def publishRelay(channel, state):
+        if generation == 1:
+            broker.publish(mqttId + u"/relay/" + str(channel), u"on" if state else u"off")
+        else:
+            broker.publish(mqttId + u"/status/switch:" + str(channel), json.dumps({'id': channel, 'output': state}))
+
+    def publishAll():
+        with device.lock:
+            device.expireTimers()
+            relayStates = list(device.channels)
+        for channel in range(len(relayStates)):
+            publishRelay(channel, relayStates[channel])
+
+    def onCommand(topic, payload):
+        if payload in (b"update", b"status_update"):
+            publishAll()
+
+    def onRelayCommand(topic, payload):
+        channel = int(topic.split(u"/")[-2])
+        device.setRelay(channel, payload == b"on")
+
+    def onRPC(topic, payload):
+        request = json.loads(payload)
+        if request.get('method') == u"Switch.Set":
+            params = request.get('params', {})
+            device.setRelay(int(params.get('id', 0)), bool(params.get('on')), float(params.get('toggle_after', 0)))
+
+    broker.subscribe(mqttId + u"/command", onCommand)
+    if generation == 1:
+        for channel in range(len(device.channels)):
+            broker.subscribe(mqttId + u"/relay/" + str(channel) + u"/command", onRelayCommand)
+    else:
+        broker.subscribe(mqttId + u"/rpc", onRPC)
+
+    device.relayListeners.append(publishRelay)
+    broker.publish(mqttId + u"/online", u"true")
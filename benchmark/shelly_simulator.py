@@ -0,0 +1,174 @@
+"""
+Local stand-in for Shelly relays, to test and measure advance pump plugin without devices.
+Each simulated device listen in one port of 127.0.0.1, address of pump is 127.0.0.1:port.
+Answer Gen1 API (/status, /relay/<channel>) and Gen2 RPC (Shelly.GetStatus, Switch.GetStatus, Switch.Set).
+Auto-off timers (Gen1 timer, Gen2 toggle_after) turn off relay when they expire.
+"""
+
+# Python 2/3 compatibility imports
+from __future__ import print_function
+
+# standard library imports
+import argparse
+import json
+import random
+import threading
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class SimulatedShelly(object):
+    """
+    One simulated device with configurable latency, lost requests and requests without answer
+    """
+
+    def __init__(self, port = 0, channels = 1, latency = 0.0, jitter = 0.0, lossRate = 0.0, timeoutRate = 0.0, timeoutTime = 30.0):
+        self.channels = [False] * channels
+        self.offTimes = [None] * channels # monotonic time of auto-off of each relay
+        self.latency = latency
+        self.jitter = jitter
+        self.lossRate = lossRate
+        self.timeoutRate = timeoutRate
+        self.timeoutTime = timeoutTime
+
+        # (monotonic time, channel, new state) of each relay command
+        self.commandLog = []
+        self.statusRequests = 0
+        self.relayListeners = [] # called with (channel, state) after each relay command
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((u"127.0.0.1", port), self.handlerClass())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        return u"127.0.0.1:" + str(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def setRelay(self, channel, state, timer = 0.0):
+        self.lock.acquire()
+        if channel < len(self.channels):
+            self.expireTimers()
+            self.channels[channel] = state
+            self.offTimes[channel] = monotonic() + timer if state and timer > 0 else None
+            self.commandLog.append((monotonic(), channel, state))
+        self.lock.release()
+
+        for listener in self.relayListeners:
+            listener(channel, state)
+
+    def expireTimers(self):
+        """ Turn off relays with expired auto-off timer, call with lock"""
+        checkTime = monotonic()
+        for channel in range(len(self.channels)):
+            if self.offTimes[channel] is not None and self.offTimes[channel] <= checkTime:
+                self.channels[channel] = False
+                self.commandLog.append((self.offTimes[channel], channel, False))
+                self.offTimes[channel] = None
+
+    def answer(self, path, query):
+        """ Return JSON answer of request or None if path is unknown"""
+        self.lock.acquire()
+        try:
+            self.expireTimers()
+            if path == u"/status" or path == u"/rpc/Shelly.GetStatus":
+                self.statusRequests += 1
+                if path == u"/status":
+                    return {'relays': [{'ison': state} for state in self.channels]}
+                return dict((u"switch:" + str(channel), {'id': channel, 'output': self.channels[channel]}) for channel in range(len(self.channels)))
+            if path == u"/rpc/Switch.GetStatus":
+                self.statusRequests += 1
+                channel = int(query.get('id', ['0'])[0])
+                return {'id': channel, 'output': self.channels[channel]}
+        finally:
+            self.lock.release()
+
+        if path.startswith(u"/relay/"):
+            channel = int(path[len(u"/relay/"):])
+            if 'turn' in query:
+                self.setRelay(channel, query['turn'][0] == u"on", float(query.get('timer', ['0'])[0]))
+            return {'ison': self.channels[channel], 'has_timer': self.offTimes[channel] is not None}
+        if path == u"/rpc/Switch.Set":
+            channel = int(query.get('id', ['0'])[0])
+            self.lock.acquire()
+            self.expireTimers()
+            wasOn = self.channels[channel]
+            self.lock.release()
+            self.setRelay(channel, query.get('on', ['false'])[0] == u"true", float(query.get('toggle_after', ['0'])[0]))
+            return {'was_on': wasOn}
+
+        return None
+
+    def handlerClass(self):
+        device = self
+
+        class ShellyRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if random.random() < device.lossRate:
+                    # connection closed without answer
+                    self.close_connection = True
+                    return
+                if random.random() < device.timeoutRate:
+                    sleep(device.timeoutTime)
+
+                delay = device.latency + random.uniform(-device.jitter, device.jitter)
+                if delay > 0:
+                    sleep(delay)
+
+                requestURL = urlparse(self.path)
+                response = device.answer(requestURL.path, parse_qs(requestURL.query))
+                if response is None:
+                    self.send_error(404)
+                    return
+
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ShellyRequestHandler
+
+def startDevices(count, **deviceOptions):
+    """ Start count devices in free ports, return list of devices"""
+    return [SimulatedShelly(**deviceOptions).start() for _ in range(count)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Simulated Shelly relays for advance pump plugin")
+    parser.add_argument("--devices", type = int, default = 1, help = "number of devices")
+    parser.add_argument("--base-port", type = int, default = 8100, help = "port of first device, next devices use next ports")
+    parser.add_argument("--channels", type = int, default = 1, help = "relays in each device")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "seconds to answer")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "random seconds added or removed to latency")
+    parser.add_argument("--loss", type = float, default = 0.0, help = "fraction of requests closed without answer")
+    parser.add_argument("--timeout-rate", type = float, default = 0.0, help = "fraction of requests answered after --timeout-time")
+    parser.add_argument("--timeout-time", type = float, default = 30.0, help = "seconds to answer slow requests")
+    args = parser.parse_args()
+
+    devices = []
+    for deviceIdx in range(args.devices):
+        devices.append(SimulatedShelly(args.base_port + deviceIdx, args.channels, args.latency, args.jitter, args.loss, args.timeout_rate, args.timeout_time).start())
+        print("Simulated device", devices[-1].address)
+
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        for device in devices:
+            device.stop()